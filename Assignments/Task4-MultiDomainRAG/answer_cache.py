@@ -0,0 +1,150 @@
+# answer_cache.py
+
+# ==============================================================================
+# Semantic answer cache for the /chat endpoint
+# ==============================================================================
+# Many guests ask the same thing in slightly different words ("what time is
+# check-in?", "When is check in?"). Each of those normally costs a router LLM
+# call, a retrieval and a generation LLM call. SemanticAnswerCache keeps past
+# (query, route, answer) entries in a small in-memory FAISS inner-product index
+# over normalized query embeddings, and returns the stored answer when a new
+# question is close enough to one already answered.
+#
+# Embeddings put "what time is check-in?" and "what time is check-out?" well
+# above the 0.95 threshold, and the same goes for "when is late check-out?" or
+# "is breakfast not included?" next to the question without the extra word, yet
+# each of them needs a different answer. So a match must also have the same
+# content words as the cached question: only STOPWORDS, the words that frame a
+# question ("what time is", "can you tell me"), may differ. Negations and
+# qualifiers (not, no, late, early, extra, ...) are content words. The embedding
+# still has to agree, so a reordered question with different meaning is not
+# matched on its words alone. The nearest few entries are tried, so a rejected
+# neighbour does not hide an acceptable one.
+#
+# Every entry remembers the version (index fingerprint) of the domain it was
+# answered from. set_domain_version() drops a domain's entries when its version
+# changes; app.py calls it once per domain when the Pipeline opens the index.
+# The index is not reloaded while the process runs, so the versions cannot go
+# stale. Whatever reloads the index in place later must call it again.
+import threading
+import faiss
+import numpy as np
+from router_cache import normalize_question
+from tracing import record_cache
+
+# Words that do not change what a question asks for. "time" is here because
+# "what time is check-in?" asks the same as "when is check-in?".
+STOPWORDS = frozenset("""
+a an the is are was be do does did can could would will i we me my our you your
+what when where which who how please tell about there any some to of for it this
+time
+""".split())
+
+
+def content_words(text):
+    """The words of a question that are not STOPWORDS, normalized as for the router cache."""
+    return frozenset(normalize_question(text).split()) - STOPWORDS
+
+
+def same_question(words, other_words):
+    """True when the two questions differ in STOPWORDS only."""
+    return words == other_words
+
+
+class SemanticAnswerCache:
+    """Returns stored answers for questions that are near-duplicates of past ones."""
+
+    def __init__(self, embeddings, threshold=0.95, max_entries=1000, candidates=4):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.candidates = candidates
+        self._index = None
+        self._entries = {}
+        self._next_id = 0
+        self._domain_versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.near_misses = 0
+
+    def _embed(self, query):
+        vector = np.asarray([self.embeddings.embed_query(query)], dtype="float32")
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _remove(self, ids):
+        if not ids:
+            return
+        self._index.remove_ids(np.asarray(ids, dtype="int64"))
+        for entry_id in ids:
+            self._entries.pop(entry_id, None)
+
+    def lookup(self, query):
+        """Returns (route, answer) for a cached near-duplicate, or None."""
+        result = self._lookup(self._embed(query), content_words(query))
+        record_cache("answer", hits=int(result is not None), misses=int(result is None))
+        return result
+
+    def _lookup(self, vector, words):
+        with self._lock:
+            if self._index is None or not self._entries:
+                self.misses += 1
+                return None
+            scores, ids = self._index.search(vector, min(self.candidates, len(self._entries)))
+            for score, entry_id in zip(scores[0], ids[0]):
+                entry = self._entries.get(int(entry_id))
+                if entry is None or score < self.threshold:
+                    break
+                if not same_question(words, entry["words"]):
+                    self.near_misses += 1
+                    continue
+                if entry["version"] != self._domain_versions.get(entry["route"]):
+                    # Answered from an older index of this domain.
+                    continue
+                self.hits += 1
+                return entry["route"], entry["answer"]
+            self.misses += 1
+            return None
+
+    def add(self, query, route, answer):
+        """Stores an answer for a query, evicting the oldest entry when full."""
+        vector = self._embed(query)
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexIDMap(faiss.IndexFlatIP(vector.shape[1]))
+            if len(self._entries) >= self.max_entries:
+                # Dicts keep insertion order, so the first key is the oldest entry.
+                self._remove([next(iter(self._entries))])
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.asarray([entry_id], dtype="int64"))
+            self._entries[entry_id] = {
+                "query": query,
+                "words": content_words(query),
+                "route": route,
+                "answer": answer,
+                "version": self._domain_versions.get(route),
+            }
+
+    def invalidate_domain(self, domain):
+        """Drops every cached answer that was produced from the given domain."""
+        with self._lock:
+            ids = [i for i, e in self._entries.items() if e["route"] == domain]
+            self._remove(ids)
+        if ids:
+            print(f"Answer cache: dropped {len(ids)} entries for '{domain}'.")
+
+    def set_domain_version(self, domain, version):
+        """Records the current index version of a domain, invalidating it on change."""
+        with self._lock:
+            previous = self._domain_versions.get(domain)
+            self._domain_versions[domain] = version
+        if previous is not None and previous != version:
+            self.invalidate_domain(domain)
+
+    def stats(self):
+        """Returns hit/miss counters and the number of cached answers."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "near_misses": self.near_misses,
+                    "entries": len(self._entries)}
@@ -4,19 +4,39 @@
 # Step 1: Import essential tools and set up the OpenAI API environment
 # ==============================================================================
 import os
-import json # Import the json module to parse the router's output
-from flask import Flask, render_template_string, request, jsonify
+import math
+import time
+import itertools
+import uuid
+import threading
+import httpx
+import json
+from flask import Blueprint, Flask, Response, render_template_string, request, jsonify, stream_with_context
 from dotenv import load_dotenv, find_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.messages import HumanMessage, AIMessage
 from langchain.prompts import PromptTemplate
 from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain 
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableBranch
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+from index_store import load_or_build_index, index_version, INDEX_ROOT, INDEX_NAME
+from embedding_cache import cached_openai_embeddings
+from answer_cache import SemanticAnswerCache
+from semantic_router import EmbeddingRouter
+from router_cache import CachedRouter, KeywordRouter, parse_route, normalize_question
+from single_flight import SingleFlight
+from rate_limiter import (
+    RateLimiter, RateLimitedTransport, AsyncRateLimitedTransport, request_priority, retry_after_of, BACKGROUND,
+)
+from session_store import make_history_store
+from context_packer import pack_documents
+from reranker import LexicalReranker
+from multi_domain_index import MultiDomainIndex
+from domain_registry import DomainRegistry, load_domain_config
+from ingest_pipeline import load_concurrently, split_parallel
+from tracing import RequestTrace, render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
 # ==============================================================================
 # Step 2: Set up the OpenAI API Key
@@ -24,90 +44,176 @@ from langchain_core.runnables import RunnablePassthrough, RunnableLambda, Runnab
 # Use dotenv to load environment variables from a .env file
 load_dotenv(find_dotenv())
 
-# Initialize the LLM and Embeddings model
-# Setting temperature to 0 for more consistent responses
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-embeddings = OpenAIEmbeddings()
+# Shared HTTP connection pools for the LLM and embedding clients, so concurrent
+# requests reuse keep-alive connections instead of opening new ones. The OpenAI
+# clients honour OPENAI_BASE_URL, which can point at a local stub server
+# (see stub_openai_server.py).
+http_limits = httpx.Limits(
+    max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", "20")),
+)
+
+# Every OpenAI call of the process goes through one client-side rate limiter:
+# OPENAI_RPM requests and OPENAI_TPM tokens per minute, up to OPENAI_MAX_RETRIES
+# jittered retries of a 429/5xx, and interactive calls ahead of ingestion. When
+# OPENAI_QUEUE_SIZE interactive calls are already waiting, or one waits longer
+# than OPENAI_QUEUE_TIMEOUT seconds, /chat answers 503 with Retry-After (see
+# rate_limiter.py). So does /chat/stream when this happens before the route is
+# decided; after that, its closing 'error' event carries 'retry_after'.
+# OPENAI_RATE_LIMIT=false sends calls straight through.
+OPENAI_RATE_LIMIT = os.getenv("OPENAI_RATE_LIMIT", "true").lower() == "true"
+openai_limiter = RateLimiter(
+    requests_per_minute=int(os.getenv("OPENAI_RPM", "500")),
+    tokens_per_minute=int(os.getenv("OPENAI_TPM", "200000")),
+    max_queue=int(os.getenv("OPENAI_QUEUE_SIZE", "64")),
+    max_wait=float(os.getenv("OPENAI_QUEUE_TIMEOUT", "10")),
+    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "4")),
+)
+
+def make_clients():
+    """Creates the pooled HTTP clients, the LLM and the cached embeddings model."""
+    if OPENAI_RATE_LIMIT:
+        http_client = httpx.Client(transport=RateLimitedTransport(openai_limiter, limits=http_limits))
+        http_async_client = httpx.AsyncClient(transport=AsyncRateLimitedTransport(openai_limiter, limits=http_limits))
+    else:
+        http_client = httpx.Client(limits=http_limits)
+        http_async_client = httpx.AsyncClient(limits=http_limits)
+    # The limiter's transport does the retrying, so the SDK's own retries are off.
+    max_retries = 0 if OPENAI_RATE_LIMIT else 2
+
+    # Initialize the LLM and Embeddings model
+    # Setting temperature to 0 for more consistent responses
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, max_retries=max_retries,
+                     http_client=http_client, http_async_client=http_async_client)
+    # Embeddings are cached by (model, normalized text), see embedding_cache.py.
+    embeddings = cached_openai_embeddings(max_retries=max_retries, http_client=http_client,
+                                          http_async_client=http_async_client)
+    return http_client, http_async_client, llm, embeddings
 
 # ==============================================================================
 # Step 3: Prepare Data
 # ==============================================================================
-def load_data_from_file(file_path):
-    """Loads and splits a single text file."""
-    try:
-        print(f"Loading data from {file_path}...")
-        loader = TextLoader(file_path)
-        documents = loader.load()
-        # Increased chunk size for better context.
-        # A small chunk size of 20 characters is often too little.
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-        chunks = text_splitter.split_documents(documents)
-        print(f"Loaded {len(chunks)} chunks from {file_path}.")
-        return chunks
-    except FileNotFoundError:
-        print(f"Error: The file {file_path} was not found. Please create it.")
-        exit()
-
-
-# Ingest data from the three specified files
-try:
-    dining_docs = load_data_from_file("./dining.txt")
-    rooms_docs = load_data_from_file("./rooms.txt")
-    wellness_docs = load_data_from_file("./wellness.txt")
-except FileNotFoundError:
-    print("Please make sure the dining.txt, rooms.txt, and wellness.txt files exist in the current directory.")
-    exit()
-    
+# Increased chunk size for better context.
+# A small chunk size of 20 characters is often too little.
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+
+# The hotel departments are configured in domains.yaml (or the file named by
+# DOMAIN_CONFIG): source file, prompt specialty and routing description.
+DOMAIN_CONFIG = os.getenv("DOMAIN_CONFIG", "./domains.yaml")
+
+# Source files are read in a thread pool and split per domain; set
+# INGEST_SPLIT_PROCESSES to split large corpora in that many worker processes.
+# New chunks are embedded INGEST_BATCH_SIZE at a time with at most
+# INGEST_MAX_IN_FLIGHT batches outstanding (see ingest_pipeline.py).
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+INGEST_SPLIT_PROCESSES = int(os.getenv("INGEST_SPLIT_PROCESSES", "0"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "128"))
+INGEST_MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "4"))
+
+def load_domain_chunks(files):
+    """Loads {domain: text file} concurrently and splits each domain into chunks."""
+    print(f"Loading data from {', '.join(files.values())}...")
+    documents = load_concurrently(
+        {domain: TextLoader(path).load for domain, path in files.items()},
+        max_workers=INGEST_WORKERS,
+    )
+    chunks = split_parallel(documents, CHUNK_SIZE, CHUNK_OVERLAP, processes=INGEST_SPLIT_PROCESSES)
+    for domain, domain_chunks in chunks.items():
+        print(f"Loaded {len(domain_chunks)} chunks from {files[domain]}.")
+    return chunks
+
 
 # ==============================================================================
-# Step 4: Create Embeddings and Vector Stores for each domain
+# Step 4: Create Embeddings and the shared Vector Store for all domains
 # ==============================================================================
-# Create a dictionary of FAISS vector stores directly from the loaded documents.
-print("Creating FAISS vector stores for all domains...")
-vector_stores = {
-    "dining": FAISS.from_documents(dining_docs, embeddings),
-    "rooms": FAISS.from_documents(rooms_docs, embeddings),
-    "wellness": FAISS.from_documents(wellness_docs, embeddings)
-}
-print("FAISS vector stores created successfully.")
+# All domains share one FAISS index, saved under ./index/all together with a
+# fingerprint of every source file and the splitter settings. Unchanged domains
+# are reused from disk; only domains whose inputs changed are split and embedded
+# again. Every chunk is tagged with its domain, and each entry of vector_stores is
+# a view that searches only that domain's vectors. Adding a domain only needs a
+# new entry in domains.yaml. The saved index is opened through memory maps (see
+# mmap_store.py), so a warm start does not read it into memory and gunicorn
+# workers share a single copy.
+def load_vector_stores(domain_config, embeddings):
+    """Opens (or builds) the shared index; returns the MultiDomainIndex and one view per domain."""
+    domain_files = {name: settings["source"] for name, settings in domain_config.items()}
+    print("Loading the FAISS vector store for all domains...")
+    try:
+        # Ingestion embeddings wait behind guests' requests at the rate limiter.
+        with request_priority(BACKGROUND):
+            store = load_or_build_index(domain_files, embeddings, load_domain_chunks,
+                                        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                        batch_size=INGEST_BATCH_SIZE, max_in_flight=INGEST_MAX_IN_FLIGHT)
+    except FileNotFoundError as e:
+        raise FileNotFoundError(
+            f"Please make sure the source files exist: {', '.join(domain_files.values())}."
+        ) from e
+    # Domains with an 'index' block in domains.yaml are searched through their own
+    # approximate index (IVF-Flat, HNSW or IVF-PQ), trained once and cached under
+    # ./index/all/ann; the others use exact search on the shared index.
+    index_settings = {name: settings["index"] for name, settings in domain_config.items() if settings.get("index")}
+    multi_domain_index = MultiDomainIndex(store, index_settings=index_settings,
+                                          cache_dir=os.path.join(INDEX_ROOT, INDEX_NAME, "ann"))
+    vector_stores = {domain: multi_domain_index.view(domain) for domain in domain_files}
+    print(f"FAISS vector store ready: {multi_domain_index.counts}")
+    print(f"Embedding cache: {embeddings.stats()}")
+    return multi_domain_index, vector_stores
 
 # ==============================================================================
 # Step 5: Build Domain-Specific Retrievers and Prompts
 # ==============================================================================
-# Set up a retriever for each vector store.
-retrievers = {
-    "dining": vector_stores["dining"].as_retriever(),
-    "rooms": vector_stores["rooms"].as_retriever(),
-    "wellness": vector_stores["wellness"].as_retriever()
-}
-
-# Define prompt templates for each domain.
-dining_template = """
-You are a concierge AI assistant for a luxury hotel, specializing in dining.
-Answer the user's question based ONLY on the following context. If the answer is not
-in the context, state that you cannot provide information on that topic.
-
-Context:
-{context}
-
-Question:
-{input}
-"""
-
-rooms_template = """
-You are a concierge AI assistant for a luxury hotel, specializing in rooms and hotel policies.
-Answer the user's question based ONLY on the following context. If the answer is not
-in the context, state that you cannot provide information on that topic.
-
-Context:
-{context}
-
-Question:
-{input}
-"""
-
-wellness_template = """
-You are a concierge AI assistant for a luxury hotel, specializing in wellness and fitness.
+# Retrieved chunks are deduplicated, overlapping neighbours are merged and the
+# result is cut to CONTEXT_TOKEN_BUDGET tokens before it is stuffed into {context}.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+# RETRIEVAL_MODE=hybrid fuses each domain's BM25 ranking with its vector ranking
+# (see lexical_index.py); a question whose terms all occur in the best BM25 chunk
+# (confidence >= LEXICAL_FAST_PATH) is answered from BM25 alone without being
+# embedded. RETRIEVAL_MODE=dense keeps vector-only retrieval. Speculative and
+# batch retrieval use the same rankings, with the question embeddings they
+# already computed.
+#
+# Note that /chat and /chat/stream embed every question for the answer cache
+# lookup before retrieval starts (and ROUTER_MODE=centroid|index embeds it too). So
+# on those endpoints the fast path saves a vector search, not an OpenAI call:
+# the retriever's embed_query is then served by the embedding cache (see
+# embedding_cache.py). It saves the embedding call where nothing else embedded
+# the question first, e.g. the domain chains used directly.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "20"))
+LEXICAL_FAST_PATH = float(os.getenv("LEXICAL_FAST_PATH", "1.0"))
+
+# With RERANK on, retrieval over-fetches RERANK_FETCH_K chunks per question and a
+# local reranker keeps the best RERANK_TOP_N of them, scoring for at most
+# RERANK_BUDGET_MS (see reranker.py). RERANK=false passes the top 4 as retrieved.
+RERANK = os.getenv("RERANK", "true").lower() == "true"
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", "12"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "3"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "25"))
+# Chunks retrieved per question and domain.
+RETRIEVE_K = RERANK_FETCH_K if RERANK else 4
+reranker = LexicalReranker(top_n=RERANK_TOP_N, budget_ms=RERANK_BUDGET_MS) if RERANK else None
+
+def pack_context(docs):
+    """Packs retrieved documents into the context token budget."""
+    return pack_documents(docs, token_budget=CONTEXT_TOKEN_BUDGET)
+
+def select_context(query, docs):
+    """Reranks the retrieved documents (if RERANK is on) and packs them into the context."""
+    if reranker is not None:
+        docs = reranker.rerank(query, docs)
+    return pack_context(docs)
+
+def packed_retriever(retriever):
+    """Retrieval runnable for create_retrieval_chain that reranks and packs the retrieved documents."""
+    return RunnablePassthrough.assign(docs=RunnableLambda(lambda x: x["input"]) | retriever) \
+        | RunnableLambda(lambda x: select_context(x["input"], x["docs"]))
+
+# Prompt template shared by all domains; {specialty} comes from domains.yaml.
+# A domain can replace it entirely with its own 'template'.
+domain_template = """
+You are a concierge AI assistant for a luxury hotel, specializing in {specialty}.
 Answer the user's question based ONLY on the following context. If the answer is not
 in the context, state that you cannot provide information on that topic.
 
@@ -120,15 +226,14 @@ Question:
 
 # Define a prompt for the router chain to help it decide which domain to use.
 # The prompt now explicitly asks for 'next_inputs' as a string.
+# The list of domains is filled in from domains.yaml.
 router_template = """
 Given a user's question, determine the most relevant domain to route it to.
 The available domains are:
-1. dining: For questions about restaurants, menus, and dining hours.
-2. rooms: For questions about room types, amenities, and hotel policies like check-in/out.
-3. wellness: For questions about the spa, gym, pool, and yoga classes.
+{domain_list}
 If the question does not fit any of the domains, categorize it as "default".
 
-Respond with a single JSON object. The JSON object should have two keys: 'destination' and 'next_inputs'. The value of 'destination' should be the name of the most relevant domain (dining, rooms, wellness) or 'default' if none apply. The value of 'next_inputs' should be the original user question as a string.
+Respond with a single JSON object. The JSON object should have two keys: 'destination' and 'next_inputs'. The value of 'destination' should be the name of the most relevant domain ({domain_names}) or 'default' if none apply. The value of 'next_inputs' should be the original user question as a string.
 
 Example JSON:
 {{
@@ -143,48 +248,427 @@ Response:
 # ==============================================================================
 # Step 6: Implement a Router Chain (using modern LCEL approach)
 # ==============================================================================
-# Define the destination chains using the modern approach.
-dining_doc_chain = create_stuff_documents_chain(llm, ChatPromptTemplate.from_template(dining_template))
-rooms_doc_chain = create_stuff_documents_chain(llm, ChatPromptTemplate.from_template(rooms_template))
-wellness_doc_chain = create_stuff_documents_chain(llm, ChatPromptTemplate.from_template(wellness_template))
-
-# Create the retrieval chains for each domain
-dining_chain = create_retrieval_chain(retrievers["dining"], dining_doc_chain)
-rooms_chain = create_retrieval_chain(retrievers["rooms"], rooms_doc_chain)
-wellness_chain = create_retrieval_chain(retrievers["wellness"], wellness_doc_chain)
-
-# Create the default chain for non-domain questions using LCEL
-default_prompt = ChatPromptTemplate.from_template(
-    "You are a general concierge AI assistant. You cannot provide information about specific hotel policies, dining, or wellness services. Please state that you can only answer general questions. User's question: {input}"
-)
-default_chain = default_prompt | llm
-
-# Create the router chain. It's a runnable sequence: prompt -> llm -> parse JSON
-router_prompt = PromptTemplate(template=router_template, input_variables=["input"])
-router_chain = router_prompt | llm | RunnableLambda(lambda x: json.loads(x.content))
-
-# Use a RunnableBranch to route the requests based on the router's output.
-# The router's output is expected to be a JSON object with a 'destination' key.
-# We will use this key to route to the correct chain.
-full_chain = (
-    RunnablePassthrough.assign(
-        route=router_chain,
-    )
-    | RunnableBranch(
-        (lambda x: x["route"]["destination"] == "dining", dining_chain),
-        (lambda x: x["route"]["destination"] == "rooms", rooms_chain),
-        (lambda x: x["route"]["destination"] == "wellness", wellness_chain),
-        default_chain,
-    )
-)
+# Pick the router by config. ROUTER_MODE=llm keeps the LLM router;
+# "centroid" and "index" route locally by embedding similarity and only call the
+# LLM router when the decision is ambiguous (see semantic_router.py).
+ROUTER_MODE = os.getenv("ROUTER_MODE", "llm")
+
+# Whatever the mode, decisions are cached by normalized question, and a question
+# that matches the 'keywords' of a single domain is routed without the router
+# (see router_cache.py). ROUTER_CACHE_SIZE=0 turns the cache off, and
+# KEYWORD_ROUTER=false the keyword matching.
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", "5000"))
+KEYWORD_ROUTER = os.getenv("KEYWORD_ROUTER", "true").lower() == "true"
+
+# Speculative mode: retrieval against the FAISS stores is cheap next to the router
+# LLM call, so it runs for every domain while the router is still deciding. The
+# query is embedded once and searched in all stores; only the chosen domain's
+# documents are then passed to its documents chain.
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+
+# Batched questions (QA replays of logged guest questions, offline traffic).
+# Instead of N independent full_chain runs, the questions are embedded in one
+# call, routed together, searched with one FAISS call per domain over the query
+# matrix, and only generation is fanned out, BATCH_CONCURRENCY at a time.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "1000"))
+
+def timed(name, runnable):
+    """
+    Wraps a runnable so it runs under `name`, which is how tracing.py finds the
+    stage and records its time.
+    """
+    def run(x, config):
+        return runnable.invoke(x, config)
+
+    async def arun(x, config):
+        return await runnable.ainvoke(x, config)
+    return RunnableLambda(run, afunc=arun, name=name)
+
+# Streaming: the route decision is emitted first, then the answer tokens as the
+# chosen chain generates them. Both the retrieval chains and the default chain
+# stream dict chunks whose 'answer' key carries the tokens.
+def _token_from_chunk(chunk):
+    return chunk.get("answer") if isinstance(chunk, dict) else None
+
+
+class Pipeline:
+    """
+    The LLM clients, the shared index and every chain of the assistant. There
+    is one per process, built on first use by get_pipeline() (see Step 7).
+    """
+
+    def __init__(self):
+        start = time.perf_counter()
+        self.http_client, self.http_async_client, self.llm, self.embeddings = make_clients()
+        self.domain_config = load_domain_config(DOMAIN_CONFIG)
+        self.multi_domain_index, self.vector_stores = load_vector_stores(self.domain_config, self.embeddings)
+
+        # Domain chains are built on the first request routed to each domain.
+        self.domain_registry = DomainRegistry(self.domain_config, self.build_domain_chains)
+
+        # Create the default chain for non-domain questions using LCEL. Like the
+        # retrieval chains it returns the inputs plus an 'answer' string.
+        default_prompt = ChatPromptTemplate.from_template(
+            "You are a general concierge AI assistant. You cannot provide information about specific hotel policies, dining, or wellness services. Please state that you can only answer general questions. User's question: {input}"
+        )
+        self.default_chain = RunnablePassthrough.assign(answer=default_prompt | self.llm | StrOutputParser())
+
+        # Create the router chain. It's a runnable sequence: prompt -> llm -> parse JSON.
+        # parse_route also reads replies that are not clean JSON instead of failing.
+        router_prompt = PromptTemplate(template=router_template, input_variables=["input"]).partial(
+            domain_list=self.domain_registry.router_domain_list(),
+            domain_names=", ".join(self.domain_registry.names()),
+        )
+        domain_names = self.domain_registry.names()
+        self.router_chain = router_prompt | self.llm | RunnableLambda(lambda x: parse_route(x.content, domain_names))
+
+        self.embedding_router = None
+        if ROUTER_MODE == "llm":
+            self.route_chain = self.router_chain
+        else:
+            self.embedding_router = EmbeddingRouter(
+                self.embeddings,
+                fallback=self.router_chain,
+                mode=ROUTER_MODE,
+                vector_stores=self.vector_stores,
+                exemplars=self.domain_registry.exemplars(),
+                margin=float(os.getenv("ROUTER_MARGIN", "0.03")),
+                min_score=float(os.getenv("ROUTER_MIN_SCORE", "0.75")),
+            )
+            self.route_chain = RunnableLambda(self.embedding_router.route, afunc=self.embedding_router.aroute)
+
+        self.router_cache = None
+        if ROUTER_CACHE_SIZE > 0 or KEYWORD_ROUTER:
+            self.router_cache = CachedRouter(
+                self.route_chain,
+                keyword_router=KeywordRouter(self.domain_registry.keywords()) if KEYWORD_ROUTER else None,
+                max_entries=ROUTER_CACHE_SIZE,
+            )
+            self.route_chain = RunnableLambda(self.router_cache.route, afunc=self.router_cache.aroute)
+
+        if SPECULATIVE_RETRIEVAL:
+            self.full_chain = (
+                RunnablePassthrough.assign(
+                    route=timed("route", self.route_chain),
+                    retrieved=timed("retrieve", RunnableLambda(self.retrieve_all_domains,
+                                                               afunc=self.aretrieve_all_domains)),
+                )
+                | timed("answer", RunnableLambda(self.answer_from_retrieved, afunc=self.aanswer_from_retrieved))
+            )
+        else:
+            # Route the request, then hand it to the chosen domain's chain. The router's
+            # output is expected to be a JSON object with a 'destination' key.
+            self.full_chain = (
+                RunnablePassthrough.assign(
+                    route=timed("route", self.route_chain),
+                )
+                | timed("answer", RunnableLambda(self.dispatch, afunc=self.adispatch))
+            )
+
+        # Semantic answer cache in front of full_chain. A question whose embedding is at
+        # least ANSWER_CACHE_THRESHOLD (cosine) similar to an answered one gets the stored
+        # answer back, provided the two differ in stopwords only ("check-out" vs "late
+        # check-out" does not match, see answer_cache.py). Entries are tied to the version of the domain
+        # index they came from. The versions are set once here: the index is opened once
+        # per Pipeline and not reloaded, so they stay current for the process's lifetime.
+        self.answer_cache = SemanticAnswerCache(
+            self.embeddings,
+            threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+            max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1000")),
+        )
+        for domain in self.vector_stores:
+            self.answer_cache.set_domain_version(domain, index_version(domain))
+
+        # Identical questions (normalized as for the router cache, whatever the session)
+        # that arrive while one of them is being answered share that answer instead of
+        # each running full_chain; on /chat/stream they share the streamed events
+        # (see single_flight.py).
+        self.chat_flight = SingleFlight("chat_coalescing")
+
+        self.startup_seconds = time.perf_counter() - start
+        print(f"Pipeline ready in {self.startup_seconds:.2f}s.")
+
+    def build_domain_chains(self, name, settings):
+        """Builds the documents chain and retrieval chain for one domain."""
+        if settings.get("template"):
+            prompt = ChatPromptTemplate.from_template(settings["template"])
+        else:
+            prompt = ChatPromptTemplate.from_template(domain_template).partial(
+                specialty=settings.get("specialty", name)
+            )
+        doc_chain = create_stuff_documents_chain(self.llm, prompt)
+        if RETRIEVAL_MODE == "hybrid":
+            retriever = self.hybrid_retriever(name)
+        else:
+            retriever = self.vector_stores[name].as_retriever(k=RETRIEVE_K)
+        return {
+            "documents": doc_chain,
+            "retrieval": create_retrieval_chain(packed_retriever(retriever), doc_chain),
+        }
+
+    def hybrid_retriever(self, domain):
+        """BM25 + vector retriever of one domain (RETRIEVAL_MODE=hybrid)."""
+        return self.vector_stores[domain].as_hybrid_retriever(
+            k=RETRIEVE_K, fetch_k=max(HYBRID_FETCH_K, RETRIEVE_K), fast_path_confidence=LEXICAL_FAST_PATH
+        )
 
-# Initialize a chat history list for the Flask app.
-chat_history = []
+    def search_domain(self, domain, queries, query_vectors):
+        """
+        Retrieves RETRIEVE_K documents of one domain for each query, ranked as
+        the domain's retrieval chain would rank them, with one FAISS call.
+        """
+        if RETRIEVAL_MODE == "hybrid":
+            return self.hybrid_retriever(domain).search_batch(queries, query_vectors)
+        hits = self.multi_domain_index.search_batch(domain, query_vectors, k=RETRIEVE_K)
+        return [[doc for doc, _ in row] for row in hits]
+
+    def chain_for(self, destination):
+        """Returns the retrieval chain for a router destination, or the default chain."""
+        if destination in self.domain_registry:
+            return self.domain_registry.get(destination)["retrieval"]
+        return self.default_chain
+
+    def dispatch(self, x, config):
+        """Runs the chain picked by the router's 'destination' with one dict lookup."""
+        return self.chain_for(x["route"]["destination"]).invoke(x, config)
+
+    async def adispatch(self, x, config):
+        """Async version of dispatch."""
+        return await self.chain_for(x["route"]["destination"]).ainvoke(x, config)
+
+    def retrieve_all_domains(self, x):
+        """Searches every domain's store with a single query embedding."""
+        query_vector = self.embeddings.embed_query(x["input"])
+        return {
+            domain: self.search_domain(domain, [x["input"]], [query_vector])[0]
+            for domain in self.vector_stores
+        }
+
+    async def aretrieve_all_domains(self, x):
+        """Async version of retrieve_all_domains; the searches themselves are local."""
+        query_vector = await self.embeddings.aembed_query(x["input"])
+        return {
+            domain: self.search_domain(domain, [x["input"]], [query_vector])[0]
+            for domain in self.vector_stores
+        }
+
+    def answer_from_retrieved(self, x):
+        """Answers with the router's chosen domain, reusing the speculatively retrieved docs."""
+        destination = x["route"]["destination"]
+        inputs = {key: value for key, value in x.items() if key != "retrieved"}
+        if destination not in self.domain_registry:
+            return self.default_chain.invoke(inputs)
+        inputs["context"] = select_context(x["input"], x["retrieved"][destination])
+        inputs["answer"] = self.domain_registry.get(destination)["documents"].invoke(inputs)
+        return inputs
+
+    async def aanswer_from_retrieved(self, x):
+        """Async version of answer_from_retrieved."""
+        destination = x["route"]["destination"]
+        inputs = {key: value for key, value in x.items() if key != "retrieved"}
+        if destination not in self.domain_registry:
+            return await self.default_chain.ainvoke(inputs)
+        inputs["context"] = select_context(x["input"], x["retrieved"][destination])
+        inputs["answer"] = await self.domain_registry.get(destination)["documents"].ainvoke(inputs)
+        return inputs
+
+    def route_batch(self, x, config):
+        """
+        Routes a list of inputs together; a failed routing is returned as its
+        exception. Questions the router cache can decide skip the router.
+        """
+        config = {**config, "max_concurrency": BATCH_CONCURRENCY}
+        inputs, query_vectors = x["inputs"], x["query_vectors"]
+        routes = [None] * len(inputs)
+        if self.router_cache is not None:
+            routes = [self.router_cache.lookup(i["input"]) for i in inputs]
+        pending = [n for n, route in enumerate(routes) if route is None]
+        if not pending:
+            return routes
+
+        pending_inputs = [inputs[n] for n in pending]
+        if self.embedding_router is None:
+            decided = self.router_chain.batch(pending_inputs, config, return_exceptions=True)
+        else:
+            decided = self.embedding_router.route_batch(pending_inputs, [query_vectors[n] for n in pending], config)
+        for n, route in zip(pending, decided):
+            routes[n] = route
+            if self.router_cache is not None:
+                self.router_cache.add(inputs[n]["input"], route)
+        return routes
+
+    def answer_batch(self, questions, max_concurrency=BATCH_CONCURRENCY, callbacks=None):
+        """
+        Answers a list of questions without chat history. Returns one result per
+        question, in input order: {'input', 'route', 'answer'} or {'input', 'error'}.
+        """
+        results = [{"input": q} for q in questions]
+        valid = [i for i, q in enumerate(questions) if isinstance(q, str) and q.strip()]
+        for i in set(range(len(questions))) - set(valid):
+            results[i]["error"] = "Question must be a non-empty string."
+        if not valid:
+            return results
+
+        inputs = [{"input": questions[i], "chat_history": []} for i in valid]
+        query_vectors = self.embeddings.embed_documents([x["input"] for x in inputs])
+        routes = RunnableLambda(self.route_batch, name="route").invoke(
+            {"inputs": inputs, "query_vectors": query_vectors}, {"callbacks": callbacks}
+        )
+
+        # Group the routed questions by domain and search each domain once.
+        by_domain = {}
+        for n, route in enumerate(routes):
+            if isinstance(route, Exception):
+                continue
+            inputs[n]["route"] = route
+            inputs[n]["retrieved"] = {}
+            if route.get("destination") in self.domain_registry:
+                by_domain.setdefault(route["destination"], []).append(n)
+        for domain, members in by_domain.items():
+            docs = self.search_domain(domain, [inputs[n]["input"] for n in members], [query_vectors[n] for n in members])
+            for n, domain_docs in zip(members, docs):
+                inputs[n]["retrieved"][domain] = domain_docs
+
+        routed = [n for n, route in enumerate(routes) if not isinstance(route, Exception)]
+        answers = RunnableLambda(self.answer_from_retrieved, name="answer").batch(
+            [inputs[n] for n in routed], {"max_concurrency": max_concurrency, "callbacks": callbacks},
+            return_exceptions=True,
+        )
+        outcomes = dict(zip(routed, answers))
+        for n, route in enumerate(routes):
+            outcome = outcomes.get(n, route)
+            result = results[valid[n]]
+            if isinstance(outcome, Exception):
+                result["error"] = f"{type(outcome).__name__}: {outcome}"
+            else:
+                result["route"] = outcome["route"]["destination"]
+                result["answer"] = outcome["answer"]
+        return results
+
+    def stream_answer(self, user_query, history, callbacks=None):
+        """Yields ('route', destination) once, then ('token', text) for each answer token."""
+        inputs = {"input": user_query, "chat_history": history}
+        route = self.route_chain.invoke(inputs, {"callbacks": callbacks, "run_name": "route"})
+        yield "route", route["destination"]
+        chain = self.chain_for(route["destination"])
+        for chunk in chain.stream({**inputs, "route": route}, {"callbacks": callbacks, "run_name": "answer"}):
+            token = _token_from_chunk(chunk)
+            if token:
+                yield "token", token
+
+    async def astream_answer(self, user_query, history, callbacks=None):
+        """Async version of stream_answer."""
+        inputs = {"input": user_query, "chat_history": history}
+        route = await self.route_chain.ainvoke(inputs, {"callbacks": callbacks, "run_name": "route"})
+        yield "route", route["destination"]
+        chain = self.chain_for(route["destination"])
+        async for chunk in chain.astream({**inputs, "route": route}, {"callbacks": callbacks, "run_name": "answer"}):
+            token = _token_from_chunk(chunk)
+            if token:
+                yield "token", token
+
+# ==============================================================================
+# Step 7: Lazy, thread-safe startup
+# ==============================================================================
+# Importing this module does not call OpenAI or open the index. The Pipeline is
+# built by the first get_pipeline() call, under a lock so concurrent requests
+# wait for that one build instead of each starting their own. With
+# APP_WARMUP=background (the default) create_app() starts the build in a
+# background thread, so the server answers /healthz at once and /readyz turns
+# from 503 to 200 when the pipeline is ready. With APP_WARMUP=lazy the first
+# request, or the first /readyz probe, builds it. A failed build is reported by
+# /readyz and retried on the next probe or request.
+APP_WARMUP = os.getenv("APP_WARMUP", "background")
+
+_pipeline = None
+_pipeline_error = None
+_pipeline_lock = threading.Lock()
+_warmup_thread = None
+_warmup_lock = threading.Lock()
+
+def get_pipeline():
+    """Returns this process's Pipeline, building it on first use."""
+    global _pipeline, _pipeline_error
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                try:
+                    _pipeline = Pipeline()
+                    _pipeline_error = None
+                except Exception as e:
+                    _pipeline_error = f"{type(e).__name__}: {e}"
+                    raise
+    return _pipeline
+
+def current_pipeline():
+    """Returns the Pipeline if it is already built, without building it."""
+    return _pipeline
+
+def _warmup():
+    try:
+        get_pipeline()
+    except Exception as e:
+        print(f"Pipeline warmup failed: {e}")
+
+def start_warmup():
+    """Builds the pipeline in a background thread, unless it is built or being built."""
+    global _warmup_thread
+    with _warmup_lock:
+        if _pipeline is None and (_warmup_thread is None or not _warmup_thread.is_alive()):
+            _warmup_thread = threading.Thread(target=_warmup, name="pipeline-warmup", daemon=True)
+            _warmup_thread.start()
+
+def readiness():
+    """Returns (HTTP status, body) for /readyz, starting the build if nothing is building it."""
+    if _pipeline is not None:
+        return 200, {"status": "ready", "startup_seconds": round(_pipeline.startup_seconds, 3)}
+    start_warmup()
+    body = {"status": "starting"}
+    if _pipeline_error:
+        body["last_error"] = _pipeline_error
+    return 503, body
+
+def sse_event(event, data):
+    """Formats one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Chat histories are kept per guest session (identified by a cookie), capped in
+# turns and tokens, and evicted when idle. See session_store.py for the backends.
+history_store = make_history_store()
+SESSION_COOKIE = "session_id"
+
+def with_session_cookie(response, session_id):
+    """Attaches the session id cookie to a response."""
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="Lax")
+    return response
+
+def error_reply(error):
+    """
+    (body, status, headers) for a failed request: 503 with Retry-After when the
+    OpenAI API or its rate limit queue is overloaded, 500 for anything else.
+    """
+    retry_after = retry_after_of(error)
+    if retry_after is None:
+        return {"response": "An error occurred while processing your request."}, 500, {}
+    return ({"response": "The concierge is very busy right now. Please try again in a moment."},
+            503, {"Retry-After": str(math.ceil(retry_after))})
+
+def sse_error(error):
+    """The 'error' event that ends a stream; it carries 'retry_after' (seconds) when overloaded."""
+    body, status, headers = error_reply(error)
+    data = {"message": body["response"]}
+    if "Retry-After" in headers:
+        data["retry_after"] = int(headers["Retry-After"])
+    return sse_event("error", data)
 
 # ==============================================================================
-# Step 7: Use Flask to build a modern and beautiful chatbot interface
+# Step 8: Use Flask to build a modern and beautiful chatbot interface
 # ==============================================================================
-app = Flask(__name__)
+# The routes live on a blueprint; create_app() is the application factory
+# (flask --app app run and gunicorn 'app:create_app()' both use it, and
+# gunicorn app:app still works through the module __getattr__ at the end).
+concierge = Blueprint("concierge", __name__)
 
 # HTML template string for a clean, responsive UI with Tailwind CSS
 html_template = """
@@ -265,40 +749,86 @@ html_template = """
 
             userInput.value = '';
 
+            // Removes the loading indicator once, whichever path gets there first.
+            const removeLoading = () => {
+                if (loadingDiv.parentNode) chatHistory.removeChild(loadingDiv);
+            };
+
             try {
-                const response = await fetch('/chat', {
+                // Stream the answer: the server sends a 'route' event first, then
+                // 'token' events that are appended to the message as they arrive.
+                const response = await fetch('/chat/stream', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
                     },
                     body: JSON.stringify({ query: userMessage }),
                 });
-
-                const data = await response.json();
-
-                // Remove loading indicator
-                chatHistory.removeChild(loadingDiv);
-
-                // Get the answer from the API response
-                const assistantDiv = document.createElement('div');
-                assistantDiv.className = 'flex justify-start';
-                assistantDiv.innerHTML = `
-                    <div class="bg-gray-200 text-gray-800 p-3 rounded-xl max-w-sm">
-                        <p>${data.response}</p>
-                    </div>
-                `;
-                chatHistory.appendChild(assistantDiv);
-                chatHistory.scrollTop = chatHistory.scrollHeight;
+                if (!response.ok || !response.body) {
+                    const failure = new Error(`HTTP ${response.status}`);
+                    failure.retryAfter = response.headers.get('Retry-After');
+                    throw failure;
+                }
+
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let answerText = null;
+
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const events = buffer.split('\\n\\n');
+                    buffer = events.pop();
+
+                    for (const rawEvent of events) {
+                        let eventName = 'message';
+                        let eventData = '';
+                        for (const line of rawEvent.split('\\n')) {
+                            if (line.startsWith('event: ')) eventName = line.slice(7);
+                            else if (line.startsWith('data: ')) eventData += line.slice(6);
+                        }
+                        const payload = eventData ? JSON.parse(eventData) : {};
+
+                        if (eventName === 'error') {
+                            const failure = new Error(payload.message);
+                            failure.retryAfter = payload.retry_after;
+                            throw failure;
+                        }
+                        if (eventName !== 'token') continue;
+
+                        if (answerText === null) {
+                            removeLoading();
+                            const assistantDiv = document.createElement('div');
+                            assistantDiv.className = 'flex justify-start';
+                            assistantDiv.innerHTML = `
+                                <div class="bg-gray-200 text-gray-800 p-3 rounded-xl max-w-sm">
+                                    <p></p>
+                                </div>
+                            `;
+                            chatHistory.appendChild(assistantDiv);
+                            answerText = assistantDiv.querySelector('p');
+                        }
+                        answerText.textContent += payload.text;
+                        chatHistory.scrollTop = chatHistory.scrollHeight;
+                    }
+                }
+                removeLoading();
             } catch (error) {
                 console.error('Error:', error);
-                chatHistory.removeChild(loadingDiv);
+                removeLoading();
+                // An overloaded server says how long to wait (Retry-After header or 'retry_after').
                 const errorDiv = document.createElement('div');
                 errorDiv.className = 'flex justify-start';
                 errorDiv.innerHTML = `
                     <div class="bg-red-200 text-red-800 p-3 rounded-xl max-w-sm">
-                        <p>An error occurred. Please try again.</p>
+                        <p></p>
                     </div>
                 `;
+                errorDiv.querySelector('p').textContent = error.retryAfter
+                    ? `The concierge is very busy right now. Please try again in ${error.retryAfter} s.`
+                    : 'An error occurred. Please try again.';
                 chatHistory.appendChild(errorDiv);
                 chatHistory.scrollTop = chatHistory.scrollHeight;
             }
@@ -308,36 +838,181 @@ html_template = """
 </html>
 """
 
-@app.route("/")
+@concierge.route("/")
 def home():
     """Renders the main chatbot interface."""
     return render_template_string(html_template)
 
-@app.route("/chat", methods=["POST"])
+@concierge.route("/chat", methods=["POST"])
 def chat():
     """Endpoint to handle user queries and return chatbot responses."""
-    global chat_history
     data = request.json
     user_query = data.get("query", "")
+    session_id = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
 
     if not user_query:
         return jsonify({"response": "Please enter a query."}), 400
 
+    # The trace times every stage of this request and logs one line when it ends.
+    with RequestTrace("/chat") as trace:
+        try:
+            pipeline = get_pipeline()
+            # Serve near-duplicate questions straight from the answer cache.
+            cached = pipeline.answer_cache.lookup(user_query)
+            if cached is not None:
+                route, answer = cached
+                trace.set(route=route)
+                history_store.append_turn(session_id, user_query, answer)
+                return with_session_cookie(jsonify({"response": answer}), session_id)
+
+            # Get the response from the router chain
+            # The new chain takes a dictionary with 'input' and 'chat_history' as a list
+            def answer():
+                response = pipeline.full_chain.invoke(
+                    {"input": user_query, "chat_history": history_store.get(session_id)},
+                    {"callbacks": [trace]},
+                )
+                pipeline.answer_cache.add(user_query, response["route"]["destination"], response["answer"])
+                return response
+
+            # Guests asking the same question at the same time share one run of the chain.
+            response, shared = pipeline.chat_flight.do(normalize_question(user_query), answer)
+            trace.set(route=response["route"]["destination"], coalesced=shared)
+
+            # Add the new messages to the chat history for context in the next turn.
+            history_store.append_turn(session_id, user_query, response["answer"])
+
+            return with_session_cookie(jsonify({"response": response["answer"]}), session_id)
+        except Exception as e:
+            trace.fail(e)
+            body, status, headers = error_reply(e)
+            return jsonify(body), status, headers
+
+@concierge.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """Streams the route decision and then the answer tokens as server-sent events."""
+    data = request.json
+    user_query = data.get("query", "")
+    session_id = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+
+    if not user_query:
+        return jsonify({"response": "Please enter a query."}), 400
+
+    def generate():
+        with RequestTrace("/chat/stream") as trace:
+            started = False
+            try:
+                pipeline = get_pipeline()
+                cached = pipeline.answer_cache.lookup(user_query)
+                if cached is not None:
+                    route, answer = cached
+                    started = True
+                    yield sse_event("route", {"destination": route})
+                    yield sse_event("token", {"text": answer})
+                else:
+                    def answer_events():
+                        route, tokens = None, []
+                        for event, value in pipeline.stream_answer(user_query, history_store.get(session_id), [trace]):
+                            if event == "route":
+                                route = value
+                            else:
+                                tokens.append(value)
+                            yield event, value
+                        pipeline.answer_cache.add(user_query, route, "".join(tokens))
+
+                    # As on /chat, guests asking the same question at the same time share one
+                    # run of the chain: every one of them is sent the leader's events.
+                    events, shared = pipeline.chat_flight.stream(normalize_question(user_query), answer_events)
+                    trace.set(coalesced=shared)
+                    route, tokens = None, []
+                    for event, value in events:
+                        if event == "route":
+                            route = value
+                            started = True
+                            yield sse_event("route", {"destination": value})
+                        else:
+                            tokens.append(value)
+                            yield sse_event("token", {"text": value})
+                    answer = "".join(tokens)
+
+                trace.set(route=route)
+                history_store.append_turn(session_id, user_query, answer)
+                yield sse_event("done", {})
+            except Exception as e:
+                if not started:
+                    raise
+                trace.fail(e)
+                yield sse_error(e)
+
+    # The route is decided before the response starts: a failure up to that point
+    # (an overloaded API, the rate limit queue) is answered like on /chat, with a
+    # 503 and Retry-After. Later failures end the stream with an 'error' event.
+    events = generate()
     try:
-        # Get the response from the router chain
-        # The new chain takes a dictionary with 'input' and 'chat_history' as a list
-        response = full_chain.invoke(
-            {"input": user_query, "chat_history": chat_history}
-        )
-        
-        # Add the new messages to the chat history for context in the next turn.
-        chat_history.append(HumanMessage(content=user_query))
-        chat_history.append(AIMessage(content=response["answer"]))
-        
-        return jsonify({"response": response["answer"]})
+        first = next(events)
     except Exception as e:
-        print(f"An error occurred: {e}")
-        return jsonify({"response": "An error occurred while processing your request."}), 500
+        body, status, headers = error_reply(e)
+        return jsonify(body), status, headers
+    response = Response(stream_with_context(itertools.chain([first], events)), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return with_session_cookie(response, session_id)
+
+@concierge.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """Answers a list of questions in one request; results come back in input order."""
+    data = request.json
+    questions = data.get("questions")
+
+    if not isinstance(questions, list) or not questions:
+        return jsonify({"response": "Please send a non-empty 'questions' list."}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"response": f"At most {BATCH_MAX_QUESTIONS} questions per batch."}), 400
+
+    with RequestTrace("/chat/batch") as trace:
+        try:
+            results = get_pipeline().answer_batch(questions, callbacks=[trace])
+            trace.set(questions=len(results), failed=sum("error" in r for r in results))
+            return jsonify({"results": results})
+        except Exception as e:
+            trace.fail(e)
+            body, status, headers = error_reply(e)
+            return jsonify(body), status, headers
+
+@concierge.route("/metrics")
+def metrics():
+    """Stage latency histograms, token and cache counters in the Prometheus text format."""
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+@concierge.route("/healthz")
+def healthz():
+    """Liveness: the process is up and serving, whether or not the pipeline is built."""
+    return jsonify({"status": "ok"})
+
+@concierge.route("/readyz")
+def readyz():
+    """Readiness: 200 once the pipeline is built, 503 while it is building or failed."""
+    status, body = readiness()
+    return jsonify(body), status
+
+def create_app(warmup=APP_WARMUP):
+    """
+    Builds the Flask app without building the pipeline. With warmup="background"
+    the pipeline starts building in a background thread right away; otherwise
+    the first request or /readyz probe builds it.
+    """
+    app = Flask(__name__)
+    app.register_blueprint(concierge)
+    if warmup == "background":
+        start_warmup()
+    return app
+
+def __getattr__(name):
+    """Creates the module-level `app` on first access, for `gunicorn app:app`."""
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -7,18 +7,21 @@ import os
 import json # Import the json module to parse the router's output
 from flask import Flask, render_template_string, request, jsonify
 from dotenv import load_dotenv, find_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain.prompts import PromptTemplate
 from langchain_community.document_loaders import WebBaseLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain 
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableBranch
+from embedding_cache import cached_openai_embeddings
+from ingest_pipeline import load_concurrently
+from fetch_cache import FetchCache, split_cached_pages
+from index_store import load_or_build_index
+from multi_domain_index import MultiDomainIndex
 
-from langchain_community.document_loaders import UnstructuredURLLoader 
+from unstructured.partition.html import partition_html
 
 # os.system('pip install langchain_community unstructured "unstructured[html]"')
 
@@ -31,7 +34,8 @@ load_dotenv(find_dotenv())
 # Initialize the LLM and Embeddings model
 # Setting temperature to 0 for more consistent responses
 llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-embeddings = OpenAIEmbeddings()
+# Embeddings are cached by (model, normalized text), see embedding_cache.py.
+embeddings = cached_openai_embeddings()
 
 # ==============================================================================
 # Step 3: Prepare Data from URLs
@@ -43,45 +47,40 @@ urls = {
     "wellness": "https://www.notion.so/eric-michel/wellness-251a3168f4d0800bbc51e57865cd5312"
 }
 
+# Unchanged pages are neither parsed nor re-embedded (see fetch_cache.py).
+fetch_cache = FetchCache(namespace="app2")
+
+def extract_html_text(response):
+    """Extracts page text with unstructured, the same way UnstructuredURLLoader does."""
+    elements = partition_html(text=response.text)
+    return "\n\n".join(str(el) for el in elements)
+
+def load_url_chunks(files):
+    """Splits the cached page text of {domain: text file} into chunks per domain."""
+    return split_cached_pages(files, urls, processes=int(os.getenv("INGEST_SPLIT_PROCESSES", "0")))
+
 # Ingest data from the three specified URLs
-print("Loading and splitting documents from URLs...")
+print("Loading documents from URLs...")
 try:
     # # Use WebBaseLoader to load content from the URLs
     # loader = WebBaseLoader(list(urls.values()))
     
-    # Use UnstructuredURLLoader to handle dynamic content
-    loader = UnstructuredURLLoader(urls=list(urls.values()))
-    
-    all_docs = loader.load()
-    print(f"Loaded {len(all_docs)} raw documents from the URLs.")
-
-    if not all_docs:
-        print("No documents were loaded. This may be due to a network or URL issue.")
-        exit()
-
+    # Use unstructured (as UnstructuredURLLoader does) to handle dynamic content.
+    # The pages are fetched concurrently through the fetch cache.
+    page_files = load_concurrently(
+        {domain: (lambda url=url: fetch_cache.fetch(url, extract_html_text)) for domain, url in urls.items()}
+    )
+    print(f"Fetch cache: {fetch_cache.stats()}")
 
     print("\n--- Successfully Loaded Document Content ---")
-    for doc in all_docs:
-        # The 'source' metadata field contains the URL from which the text was loaded.
-        print(f"Source URL: {doc.metadata.get('source', 'Unknown')}")
+    for domain, path in page_files.items():
+        print(f"Source URL: {urls[domain]}")
         print("Content:")
-        # The 'page_content' field holds the actual text of the document.
-        print(doc.page_content)
+        with open(path, "r", encoding="utf-8") as f:
+            print(f.read())
         print("-" * 50)
     
     print("Data loading and printing complete.")
-
-    # Split the documents for each domain
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    
-    # Filter documents based on URL to assign them to the correct domain
-    dining_docs = text_splitter.split_documents([doc for doc in all_docs if "dining" in doc.metadata.get("source", "")])
-    rooms_docs = text_splitter.split_documents([doc for doc in all_docs if "rooms" in doc.metadata.get("source", "")])
-    wellness_docs = text_splitter.split_documents([doc for doc in all_docs if "wellness" in doc.metadata.get("source", "")])
-    
-    print(f"Loaded {len(dining_docs)} chunks for dining.")
-    print(f"Loaded {len(rooms_docs)} chunks for rooms.")
-    print(f"Loaded {len(wellness_docs)} chunks for wellness.")
     
 except Exception as e:
     print(f"An error occurred while loading data from the URLs: {e}")
@@ -93,14 +92,20 @@ except Exception as e:
 # ==============================================================================
 # Step 4: Create Embeddings and Vector Stores for each domain
 # ==============================================================================
-# Create a dictionary of FAISS vector stores directly from the loaded documents.
-print("Creating FAISS vector stores for all domains...")
-vector_stores = {
-    "dining": FAISS.from_documents(dining_docs, embeddings),
-    "rooms": FAISS.from_documents(rooms_docs, embeddings),
-    "wellness": FAISS.from_documents(wellness_docs, embeddings)
-}
-print("FAISS vector stores created successfully.")
+# The cached page text is indexed like app.py's source files: one saved FAISS
+# index under ./index/web, reused as long as the text of every page is
+# unchanged. Only pages whose text changed are split and embedded again.
+print("Loading the FAISS vector store for all domains...")
+try:
+    store = load_or_build_index(page_files, embeddings, load_url_chunks,
+                                chunk_size=500, chunk_overlap=100, index_root="./index/web")
+except ValueError as e:
+    print(e)
+    exit()
+multi_domain_index = MultiDomainIndex(store)
+vector_stores = {domain: multi_domain_index.view(domain) for domain in urls}
+print(f"FAISS vector stores ready: {multi_domain_index.counts}")
+print(f"Embedding cache: {embeddings.stats()}")
 
 # ==============================================================================
 # Step 5: Build Domain-Specific Retrievers and Prompts
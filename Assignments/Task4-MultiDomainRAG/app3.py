@@ -9,16 +9,18 @@ import requests
 from bs4 import BeautifulSoup
 from flask import Flask, render_template_string, request, jsonify
 from dotenv import load_dotenv, find_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain.prompts import PromptTemplate
-from langchain_core.documents import Document # Corrected import for Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableBranch
+from embedding_cache import cached_openai_embeddings
+from ingest_pipeline import make_http_session, load_concurrently
+from fetch_cache import FetchCache, split_cached_pages
+from index_store import load_or_build_index
+from multi_domain_index import MultiDomainIndex
 
 
 # os.system('pip install requests beautifulsoup4')
@@ -31,7 +33,8 @@ load_dotenv(find_dotenv())
 
 # Initialize the LLM and Embeddings model
 llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-embeddings = OpenAIEmbeddings()
+# Embeddings are cached by (model, normalized text), see embedding_cache.py.
+embeddings = cached_openai_embeddings()
 
 # ==============================================================================
 # Step 3: Prepare Data from Notion URLs using a custom scraper
@@ -43,47 +46,46 @@ urls = {
     "wellness": "https://www.notion.so/eric-michel/wellness-251a3168f4d0800bbc51e57865cd5312"
 }
 
+# One pooled session for all pages, so the fetches reuse their connections.
+http_session = make_http_session()
+# Unchanged pages are neither parsed nor re-embedded (see fetch_cache.py).
+fetch_cache = FetchCache(namespace="app3", session=http_session)
+
+def extract_notion_text(response):
+    """Extracts the text content of a Notion page with BeautifulSoup."""
+    soup = BeautifulSoup(response.content, 'html.parser')
+
+    # Find all text content from paragraphs, headers, etc.
+    # This targets the main content body of a Notion page
+    text_content = ' '.join([p.get_text() for p in soup.find_all(['p', 'h1', 'h2', 'h3', 'li'])])
+    return text_content.strip()
+
 def scrape_notion_url(url):
     """
     Fetches text content from a Notion URL using requests and BeautifulSoup.
     This is more reliable than standard loaders for dynamically-rendered pages.
+    Returns the path of the cached text file, or None if the page could not be fetched.
     """
     try:
-        response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'})
-        response.raise_for_status()  # Raise an exception for bad status codes
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # Find all text content from paragraphs, headers, etc.
-        # This targets the main content body of a Notion page
-        text_content = ' '.join([p.get_text() for p in soup.find_all(['p', 'h1', 'h2', 'h3', 'li'])])
-        return text_content.strip()
+        return fetch_cache.fetch(url, extract_notion_text)
     except requests.exceptions.RequestException as e:
         print(f"Error fetching URL {url}: {e}")
         return None
 
-all_docs = []
-print("Loading and splitting documents from Notion URLs...")
+def load_page_chunks(files):
+    """Splits the cached page text of {domain: text file} into chunks per domain."""
+    return split_cached_pages(files, urls, processes=int(os.getenv("INGEST_SPLIT_PROCESSES", "0")))
+
+print("Loading documents from Notion URLs...")
 try:
-    for domain, url in urls.items():
-        content = scrape_notion_url(url)
-        if content:
-            doc = Document(page_content=content, metadata={"source": url, "domain": domain})
-            all_docs.append(doc)
+    # Fetch every page at the same time instead of one after another
+    page_files = load_concurrently({domain: (lambda url=url: scrape_notion_url(url)) for domain, url in urls.items()})
+    page_files = {domain: path for domain, path in page_files.items() if path}
+    print(f"Fetch cache: {fetch_cache.stats()}")
 
-    if not all_docs:
+    if not page_files:
         print("No documents were loaded. Check the URLs and your network connection.")
         exit()
-
-    # Split the documents for each domain
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-
-    dining_docs = text_splitter.split_documents([doc for doc in all_docs if doc.metadata.get("domain") == "dining"])
-    rooms_docs = text_splitter.split_documents([doc for doc in all_docs if doc.metadata.get("domain") == "rooms"])
-    wellness_docs = text_splitter.split_documents([doc for doc in all_docs if doc.metadata.get("domain") == "wellness"])
-    
-    print(f"Loaded {len(dining_docs)} chunks for dining.")
-    print(f"Loaded {len(rooms_docs)} chunks for rooms.")
-    print(f"Loaded {len(wellness_docs)} chunks for wellness.")
     
 except Exception as e:
     print(f"An error occurred while loading data: {e}")
@@ -92,13 +94,20 @@ except Exception as e:
 # ==============================================================================
 # Step 4: Create Embeddings and Vector Stores for each domain
 # ==============================================================================
-print("Creating FAISS vector stores for all domains...")
-vector_stores = {
-    "dining": FAISS.from_documents(dining_docs, embeddings),
-    "rooms": FAISS.from_documents(rooms_docs, embeddings),
-    "wellness": FAISS.from_documents(wellness_docs, embeddings)
-}
-print("FAISS vector stores created successfully.")
+# The cached page text is indexed like app.py's source files: one saved FAISS
+# index under ./index/notion, reused as long as the text of every page is
+# unchanged. Only pages whose text changed are split and embedded again.
+print("Loading the FAISS vector store for all domains...")
+try:
+    store = load_or_build_index(page_files, embeddings, load_page_chunks,
+                                chunk_size=500, chunk_overlap=100, index_root="./index/notion")
+except ValueError as e:
+    print(e)
+    exit()
+multi_domain_index = MultiDomainIndex(store)
+vector_stores = {domain: multi_domain_index.view(domain) for domain in urls}
+print(f"FAISS vector stores ready: {multi_domain_index.counts}")
+print(f"Embedding cache: {embeddings.stats()}")
 
 # ==============================================================================
 # Step 5: Build Domain-Specific Retrievers and Prompts
@@ -0,0 +1,234 @@
+# asgi_app.py
+
+# ==============================================================================
+# Async serving path for the concierge chatbot
+# ==============================================================================
+# The Flask view in app.py blocks a worker thread for the whole duration of the
+# router and generation LLM calls. This Starlette app serves the same page and
+# /chat endpoint with full_chain.ainvoke, so one process can hold many guest
+# sessions while their OpenAI calls are in flight. The LLM and embedding clients
+# share the async connection pool created in app.py, and CHAT_CONCURRENCY bounds
+# how many chains run at once. Like the Flask app it starts without the
+# pipeline: APP_WARMUP=background builds it on startup in a background thread,
+# and /healthz and /readyz report liveness and readiness meanwhile.
+#
+# Usage:
+#   uvicorn asgi_app:app --port 8000
+# For a local load test, start stub_openai_server.py and set
+# OPENAI_BASE_URL=http://127.0.0.1:8001/v1 before starting this app.
+import os
+import uuid
+import asyncio
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import HTMLResponse, JSONResponse, StreamingResponse, Response
+from starlette.routing import Route
+from app import (
+    get_pipeline, current_pipeline, start_warmup, readiness, APP_WARMUP,
+    history_store, SESSION_COOKIE, html_template, sse_event, sse_error, error_reply, BATCH_MAX_QUESTIONS,
+)
+from router_cache import normalize_question
+from tracing import RequestTrace, render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+# Upper bound on chains running at the same time in this process.
+chat_semaphore = asyncio.Semaphore(int(os.getenv("CHAT_CONCURRENCY", "100")))
+
+
+async def home(request):
+    """Renders the main chatbot interface."""
+    return HTMLResponse(html_template)
+
+
+def with_session_cookie(response, session_id):
+    """Attaches the session id cookie to a response."""
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="lax")
+    return response
+
+
+async def chat(request):
+    """Async endpoint to handle user queries and return chatbot responses."""
+    data = await request.json()
+    user_query = data.get("query", "")
+    session_id = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+
+    if not user_query:
+        return JSONResponse({"response": "Please enter a query."}, status_code=400)
+
+    # The trace times every stage of this request and logs one line when it ends.
+    with RequestTrace("/chat") as trace:
+        try:
+            # The first request may have to build the pipeline; that blocks, so it runs in a thread.
+            pipeline = await run_in_threadpool(get_pipeline)
+            # The answer cache embeds the query with the sync client, so keep it off the event loop.
+            cached = await run_in_threadpool(pipeline.answer_cache.lookup, user_query)
+            if cached is not None:
+                route, answer = cached
+                trace.set(route=route)
+                await run_in_threadpool(history_store.append_turn, session_id, user_query, answer)
+                return with_session_cookie(JSONResponse({"response": answer}), session_id)
+
+            async def answer():
+                # With SESSION_BACKEND=redis the history calls do network I/O, so they run in a thread too.
+                history = await run_in_threadpool(history_store.get, session_id)
+                async with chat_semaphore:
+                    response = await pipeline.full_chain.ainvoke(
+                        {"input": user_query, "chat_history": history},
+                        {"callbacks": [trace]},
+                    )
+                await run_in_threadpool(
+                    pipeline.answer_cache.add, user_query, response["route"]["destination"], response["answer"]
+                )
+                return response
+
+            # Guests asking the same question at the same time share one run of the chain.
+            response, shared = await pipeline.chat_flight.ado(normalize_question(user_query), answer)
+            trace.set(route=response["route"]["destination"], coalesced=shared)
+
+            await run_in_threadpool(history_store.append_turn, session_id, user_query, response["answer"])
+
+            return with_session_cookie(JSONResponse({"response": response["answer"]}), session_id)
+        except Exception as e:
+            trace.fail(e)
+            body, status, headers = error_reply(e)
+            return JSONResponse(body, status_code=status, headers=headers)
+
+
+async def chat_stream(request):
+    """Streams the route decision and then the answer tokens as server-sent events."""
+    data = await request.json()
+    user_query = data.get("query", "")
+    session_id = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+
+    if not user_query:
+        return JSONResponse({"response": "Please enter a query."}, status_code=400)
+
+    async def generate():
+        with RequestTrace("/chat/stream") as trace:
+            started = False
+            try:
+                pipeline = await run_in_threadpool(get_pipeline)
+                cached = await run_in_threadpool(pipeline.answer_cache.lookup, user_query)
+                if cached is not None:
+                    route, answer = cached
+                    started = True
+                    yield sse_event("route", {"destination": route})
+                    yield sse_event("token", {"text": answer})
+                else:
+                    async def answer_events():
+                        route, tokens = None, []
+                        history = await run_in_threadpool(history_store.get, session_id)
+                        async with chat_semaphore:
+                            async for event, value in pipeline.astream_answer(user_query, history, [trace]):
+                                if event == "route":
+                                    route = value
+                                else:
+                                    tokens.append(value)
+                                yield event, value
+                        await run_in_threadpool(pipeline.answer_cache.add, user_query, route, "".join(tokens))
+
+                    # As on /chat, guests asking the same question at the same time share one
+                    # run of the chain: every one of them is sent the leader's events.
+                    events, shared = await pipeline.chat_flight.astream(normalize_question(user_query), answer_events)
+                    trace.set(coalesced=shared)
+                    route, tokens = None, []
+                    async for event, value in events:
+                        if event == "route":
+                            route = value
+                            started = True
+                            yield sse_event("route", {"destination": value})
+                        else:
+                            tokens.append(value)
+                            yield sse_event("token", {"text": value})
+                    answer = "".join(tokens)
+
+                trace.set(route=route)
+                await run_in_threadpool(history_store.append_turn, session_id, user_query, answer)
+                yield sse_event("done", {})
+            except Exception as e:
+                if not started:
+                    raise
+                trace.fail(e)
+                yield sse_error(e)
+
+    # The route is decided before the response starts, so an overloaded API gets a
+    # 503 with Retry-After as on /chat (see chat_stream in app.py).
+    events = generate()
+    try:
+        first = await events.__anext__()
+    except Exception as e:
+        body, status, headers = error_reply(e)
+        return JSONResponse(body, status_code=status, headers=headers)
+
+    async def stream():
+        yield first
+        async for event in events:
+            yield event
+
+    response = StreamingResponse(stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return with_session_cookie(response, session_id)
+
+
+async def chat_batch(request):
+    """Answers a list of questions in one request; results come back in input order."""
+    data = await request.json()
+    questions = data.get("questions")
+
+    if not isinstance(questions, list) or not questions:
+        return JSONResponse({"response": "Please send a non-empty 'questions' list."}, status_code=400)
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return JSONResponse({"response": f"At most {BATCH_MAX_QUESTIONS} questions per batch."}, status_code=400)
+
+    with RequestTrace("/chat/batch") as trace:
+        try:
+            # answer_batch bounds its own generation concurrency and runs on the sync clients.
+            pipeline = await run_in_threadpool(get_pipeline)
+            results = await run_in_threadpool(pipeline.answer_batch, questions, callbacks=[trace])
+            trace.set(questions=len(results), failed=sum("error" in r for r in results))
+            return JSONResponse({"results": results})
+        except Exception as e:
+            trace.fail(e)
+            body, status, headers = error_reply(e)
+            return JSONResponse(body, status_code=status, headers=headers)
+
+
+async def metrics(request):
+    """Stage latency histograms, token and cache counters in the Prometheus text format."""
+    return Response(render_metrics(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+async def healthz(request):
+    """Liveness: the process is up and serving, whether or not the pipeline is built."""
+    return JSONResponse({"status": "ok"})
+
+
+async def readyz(request):
+    """Readiness: 200 once the pipeline is built, 503 while it is building or failed."""
+    status, body = readiness()
+    return JSONResponse(body, status_code=status)
+
+
+def warm_up():
+    if APP_WARMUP == "background":
+        start_warmup()
+
+
+async def close_http_clients():
+    pipeline = current_pipeline()
+    if pipeline is not None:
+        await pipeline.http_async_client.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route("/", home),
+        Route("/chat", chat, methods=["POST"]),
+        Route("/chat/stream", chat_stream, methods=["POST"]),
+        Route("/chat/batch", chat_batch, methods=["POST"]),
+        Route("/metrics", metrics),
+        Route("/healthz", healthz),
+        Route("/readyz", readyz),
+    ],
+    on_startup=[warm_up],
+    on_shutdown=[close_http_clients],
+)
@@ -0,0 +1,133 @@
+# benchmark_ann.py
+
+# ==============================================================================
+# Recall vs. latency of the approximate index types against exact search
+# ==============================================================================
+# Builds every index type supported by multi_domain_index.py (IVF-Flat, HNSW,
+# IVF-PQ) over the same vectors and sweeps its search knob (nprobe / efSearch).
+# For each setting it reports recall@k against the exact flat index, the median
+# and p95 query latency, the build (training) time and the index size, so a
+# domain's 'index' block in domains.yaml can be picked from measurements.
+#
+# The vectors are a deterministic synthetic mixture of clusters by default, or
+# one domain of a saved shared index:
+#   python benchmark_ann.py --vectors 50000 --dim 256
+#   python benchmark_ann.py --index-dir ./index/all --domain rooms
+import json
+import time
+import argparse
+import faiss
+import numpy as np
+from multi_domain_index import build_ann_index, ann_search_parameters
+
+# (settings, search knob, values to sweep)
+CONFIGS = [
+    ({"type": "ivf_flat"}, "nprobe", [1, 4, 16, 64]),
+    ({"type": "hnsw", "m": 32}, "ef_search", [16, 32, 64, 128]),
+    ({"type": "ivf_pq", "pq_m": 16}, "nprobe", [4, 16, 64]),
+    ({"type": "ivf_pq", "pq_m": 32}, "nprobe", [4, 16, 64]),
+]
+
+
+def synthetic_vectors(n, dim, queries, clusters, seed):
+    """Unit vectors drawn around random cluster centres, plus held-out queries."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype("float32")
+    points = centres[rng.integers(0, clusters, n + queries)]
+    points += 0.5 * rng.standard_normal(points.shape).astype("float32")
+    faiss.normalize_L2(points)
+    return points[:n], points[n:]
+
+
+def domain_vectors(index_dir, domain, queries, seed):
+    """One domain's vectors from a saved shared index, with perturbed copies as queries."""
+    from index_store import open_saved_index
+
+    store = open_saved_index(index_dir, None)
+    if store is None:
+        raise SystemExit(f"No saved index in {index_dir}.")
+    start, end = store.domain_ranges[domain]
+    vectors = np.array(store.vectors[start:end], dtype="float32")
+    rng = np.random.default_rng(seed)
+    query_vectors = vectors[rng.integers(0, len(vectors), queries)]
+    query_vectors = query_vectors + 0.05 * rng.standard_normal(query_vectors.shape).astype("float32")
+    faiss.normalize_L2(query_vectors)
+    return vectors, query_vectors
+
+
+def timed_search(index, queries, k, params=None):
+    """Searches one query at a time; returns the result ids and per-query latencies in ms."""
+    ids, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, row = index.search(query[None, :], k, params=params)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids.append(row[0])
+    return np.array(ids), sorted(latencies)
+
+
+def recall_at_k(found, truth):
+    k = truth.shape[1]
+    return float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs. latency of approximate FAISS indexes.")
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--index-dir", help="saved shared index to take the vectors from")
+    parser.add_argument("--domain", help="domain of --index-dir to benchmark")
+    parser.add_argument("--output", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    if args.index_dir:
+        vectors, queries = domain_vectors(args.index_dir, args.domain, args.queries, args.seed)
+    else:
+        vectors, queries = synthetic_vectors(args.vectors, args.dim, args.queries, args.clusters, args.seed)
+    n, dim = vectors.shape
+
+    flat = faiss.IndexFlatL2(dim)
+    flat.add(vectors)
+    truth, latencies = timed_search(flat, queries, args.k)
+    results = [{
+        "type": "flat", "knob": None, "value": None, "recall": 1.0, "build_s": 0.0,
+        "size_mb": len(faiss.serialize_index(flat)) / 2**20,
+        "p50_ms": latencies[len(latencies) // 2], "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+    }]
+
+    for settings, knob, values in CONFIGS:
+        start = time.perf_counter()
+        index = build_ann_index(vectors, settings)
+        build_s = time.perf_counter() - start
+        if index is None:
+            print(f"Skipping {settings}: too few vectors to train it.")
+            continue
+        size_mb = len(faiss.serialize_index(index)) / 2**20
+        for value in values:
+            found, latencies = timed_search(index, queries, args.k, ann_search_parameters({**settings, knob: value}))
+            results.append({
+                "type": settings["type"] + (f"/pq_m={settings['pq_m']}" if "pq_m" in settings else ""),
+                "knob": knob, "value": value, "recall": recall_at_k(found, truth), "build_s": build_s,
+                "size_mb": size_mb,
+                "p50_ms": latencies[len(latencies) // 2], "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+            })
+
+    print(f"\n{n} vectors x {dim} dims, {len(queries)} queries, recall@{args.k} against exact search")
+    print(f"{'index':<18}{'knob':<14}{'recall':>8}{'p50 ms':>10}{'p95 ms':>10}{'build s':>10}{'size MB':>10}")
+    for r in results:
+        knob = f"{r['knob']}={r['value']}" if r["knob"] else "-"
+        print(f"{r['type']:<18}{knob:<14}{r['recall']:>8.3f}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}"
+              f"{r['build_s']:>10.2f}{r['size_mb']:>10.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"vectors": n, "dim": dim, "k": args.k, "results": results}, f, indent=2)
+        print(f"Results saved to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+# benchmark_pipeline.py
+
+# ==============================================================================
+# Offline benchmark suite for the multi-domain RAG pipeline
+# ==============================================================================
+# Measures the pipeline end to end without network access or API costs. The LLM
+# and embedding backends are stub_openai_server.py, started in a subprocess with
+# a configurable simulated latency; its answers, routing decisions and embedding
+# vectors are deterministic, and so are the synthetic corpora and query vectors
+# generated below (fixed seeds). The suite measures:
+#   - ingest:  time and chunks/s to build the index vs. corpus size;
+#   - faiss:   per-domain query latency vs. index size, on an in-memory FAISS
+#              store and on the memory-mapped snapshot the app opens;
+#   - startup: time to import app.py and create the Flask app, and to build
+#              its pipeline (clients, index, chains) on a cold index;
+#   - chat:    /chat throughput and latency at several concurrency levels,
+#              through the Flask app and the full_chain built in app.py;
+#   - memory:  process RSS after each phase, and the raw vector bytes.
+# Results are written as JSON; --compare prints the change of every number
+# against an earlier results file.
+#
+# Usage:
+#   python benchmark_pipeline.py --latency-ms 50
+#   python benchmark_pipeline.py --latency-ms 50 --compare benchmark_results/<earlier>.json
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(HERE, "benchmark_results")
+
+DOMAIN_WORDS = {
+    "dining": "restaurant breakfast brunch dinner menu chef terrace grill wine dessert buffet vegan "
+              "reservation table lunch cocktail bar sushi pasta seafood room service".split(),
+    "rooms": "suite room check-in check-out balcony minibar pillow housekeeping view king bed "
+             "bathroom towel wi-fi safe deposit late checkout crib connecting ocean".split(),
+    "wellness": "spa massage gym yoga pool sauna steam treatment therapist facial fitness class "
+                "trainer meditation ayurvedic hydrotherapy jacuzzi wellness package".split(),
+}
+FILLER = "the a is at from to and with for our guests every daily open until available on request".split()
+
+CHAT_QUESTIONS = [
+    "What time is check-in?",
+    "Can I check out late tomorrow?",
+    "Which restaurant serves breakfast?",
+    "Is room service available at night?",
+    "Do you offer Ayurvedic massages?",
+    "When does the pool close?",
+    "Is the gym open at night?",
+    "Can you recommend a good book?",
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))] if values else 0.0
+
+
+def rss_mb():
+    """Current resident set size of this process in MB (peak RSS where /proc is missing)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub_server(latency_ms, token_delay_ms, embedding_dim):
+    """Starts stub_openai_server.py in a subprocess and returns (process, base_url)."""
+    port = free_port()
+    env = dict(os.environ, STUB_LATENCY_MS=str(latency_ms), STUB_TOKEN_DELAY_MS=str(token_delay_ms),
+               STUB_EMBEDDING_DIM=str(embedding_dim))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "stub_openai_server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=HERE, env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return process, f"http://127.0.0.1:{port}/v1"
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The stub OpenAI server did not start.")
+
+
+def synthetic_text(domain, size, seed):
+    """Deterministic pseudo-documentation for a domain, about `size` characters long."""
+    rng = random.Random(f"{seed}-{domain}")
+    words = DOMAIN_WORDS[domain]
+    paragraphs, length = [], 0
+    while length < size:
+        sentences = []
+        for _ in range(rng.randint(3, 6)):
+            sentence = " ".join(rng.choice(words if rng.random() < 0.5 else FILLER) for _ in range(rng.randint(8, 16)))
+            sentences.append(sentence.capitalize() + ".")
+        paragraph = " ".join(sentences)
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+
+def bench_ingest(workdir, sizes, seed):
+    """Builds the shared index from synthetic corpora of increasing size."""
+    from langchain_openai import OpenAIEmbeddings
+    from langchain_community.document_loaders import TextLoader
+    from index_store import load_or_build_index
+    from ingest_pipeline import load_concurrently, split_parallel
+
+    def load_chunks(files):
+        documents = load_concurrently({d: TextLoader(path).load for d, path in files.items()})
+        return split_parallel(documents, 500, 100)
+
+    results = []
+    for size in sizes:
+        corpus_dir = os.path.join(workdir, f"corpus-{size}")
+        os.makedirs(corpus_dir, exist_ok=True)
+        files = {}
+        for domain in DOMAIN_WORDS:
+            files[domain] = os.path.join(corpus_dir, f"{domain}.txt")
+            with open(files[domain], "w", encoding="utf-8") as f:
+                f.write(synthetic_text(domain, size, seed))
+
+        # The stub takes raw text; checking the context length would download the tokenizer.
+        embeddings = OpenAIEmbeddings(check_embedding_ctx_length=False)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            store = load_or_build_index(files, embeddings, load_chunks, chunk_size=500, chunk_overlap=100,
+                                        index_root=os.path.join(corpus_dir, "index"))
+        seconds = time.perf_counter() - start
+        chunks = store.ntotal
+        results.append({
+            "chars_per_domain": size,
+            "chunks": chunks,
+            "seconds": seconds,
+            "chunks_per_second": chunks / seconds if seconds else 0.0,
+            "rss_mb": rss_mb(),
+        })
+        print(f"ingest  {size:>9} chars/domain  {chunks:>6} chunks  {seconds:7.2f}s  "
+              f"{results[-1]['chunks_per_second']:8.1f} chunks/s")
+    return results
+
+
+def bench_faiss(sizes, dim, queries, seed):
+    """Measures per-domain search latency on random unit vectors of a given index size."""
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import FakeEmbeddings
+    from multi_domain_index import MultiDomainIndex
+    from mmap_store import write_snapshot, open_snapshot
+
+    rng = np.random.default_rng(seed)
+    domains = list(DOMAIN_WORDS)
+    results = []
+    for size in sizes:
+        vectors = rng.standard_normal((size, dim)).astype("float32")
+        faiss.normalize_L2(vectors)
+        index = faiss.IndexFlatL2(dim)
+        index.add(vectors)
+        ids = [str(i) for i in range(size)]
+        docstore = InMemoryDocstore({
+            ids[i]: Document(page_content=f"chunk {i}", metadata={"domain": domains[i % len(domains)]})
+            for i in range(size)
+        })
+        store = FAISS(FakeEmbeddings(size=dim), index, docstore, dict(enumerate(ids)))
+        multi_domain_index = MultiDomainIndex(store)
+
+        query_vectors = rng.standard_normal((queries, dim)).astype("float32")
+        faiss.normalize_L2(query_vectors)
+        latencies = []
+        for vector in query_vectors:
+            start = time.perf_counter()
+            multi_domain_index.search("dining", vector, k=4)
+            latencies.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        multi_domain_index.search_batch("dining", query_vectors, k=4)
+        batch_ms = (time.perf_counter() - start) * 1000
+
+        with tempfile.TemporaryDirectory(prefix="rag-snapshot-") as snapshot_root:
+            snapshot_dir = os.path.join(snapshot_root, "snapshot")
+            write_snapshot(store, snapshot_dir)
+            start = time.perf_counter()
+            snapshot_index = MultiDomainIndex(open_snapshot(snapshot_dir, store.embeddings))
+            open_ms = (time.perf_counter() - start) * 1000
+            snapshot_latencies = []
+            for vector in query_vectors:
+                start = time.perf_counter()
+                snapshot_index.search("dining", vector, k=4)
+                snapshot_latencies.append((time.perf_counter() - start) * 1000)
+            del snapshot_index
+
+        results.append({
+            "vectors": size,
+            "dim": dim,
+            "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95),
+            "batch_ms_per_query": batch_ms / queries,
+            "snapshot_open_ms": open_ms,
+            "snapshot_p50_ms": percentile(snapshot_latencies, 0.5),
+            "snapshot_p95_ms": percentile(snapshot_latencies, 0.95),
+            "vector_bytes": size * dim * 4,
+            "rss_mb": rss_mb(),
+        })
+        print(f"faiss   {size:>9} vectors  p50 {results[-1]['p50_ms']:7.3f}ms  p95 {results[-1]['p95_ms']:7.3f}ms  "
+              f"batched {results[-1]['batch_ms_per_query']:7.3f}ms/query  "
+              f"snapshot p50 {results[-1]['snapshot_p50_ms']:7.3f}ms (opened in {open_ms:.1f}ms)")
+        del store, multi_domain_index, index, vectors
+    return results
+
+
+def bench_startup():
+    """Times creating the Flask app (the pipeline is built lazily) and then building the pipeline."""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+        app.create_app(warmup="lazy")
+        app_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        app.get_pipeline()
+    result = {"app_ms": app_ms, "pipeline_s": time.perf_counter() - start, "rss_mb": rss_mb()}
+    print(f"startup app ready in {app_ms:.1f}ms, pipeline built in {result['pipeline_s']:.2f}s")
+    return result
+
+
+def bench_chat(levels, requests_per_level):
+    """Sends /chat requests through the Flask app at each concurrency level."""
+    import app
+    flask_app = app.create_app(warmup="lazy")
+
+    def send(n):
+        client = flask_app.test_client()
+        # A unique suffix keeps the embedding and answer caches out of the measurement.
+        question = f"{CHAT_QUESTIONS[n % len(CHAT_QUESTIONS)]} (request {n})"
+        start = time.perf_counter()
+        response = client.post("/chat", json={"query": question})
+        return response.status_code, (time.perf_counter() - start) * 1000
+
+    results = []
+    counter = 0
+    for level in levels:
+        batch = range(counter, counter + requests_per_level)
+        counter += requests_per_level
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=level) as pool:
+            outcomes = list(pool.map(send, batch))
+        seconds = time.perf_counter() - start
+        latencies = [ms for status, ms in outcomes if status == 200]
+        results.append({
+            "concurrency": level,
+            "requests": requests_per_level,
+            "errors": sum(status != 200 for status, _ in outcomes),
+            "seconds": seconds,
+            "throughput_rps": requests_per_level / seconds if seconds else 0.0,
+            "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95),
+            "mean_ms": statistics.mean(latencies) if latencies else 0.0,
+            "rss_mb": rss_mb(),
+        })
+        r = results[-1]
+        print(f"chat    concurrency {level:>3}  {r['throughput_rps']:7.1f} req/s  p50 {r['p50_ms']:7.1f}ms  "
+              f"p95 {r['p95_ms']:7.1f}ms  errors {r['errors']}")
+    return results
+
+
+def flatten(results, prefix=""):
+    """Flattens the numeric leaves of a results dict into {'chat.concurrency=4.p50_ms': value}."""
+    flat = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            flat.update(flatten(value, f"{prefix}{key}."))
+    elif isinstance(results, list):
+        for item in results:
+            # Rows are labelled by their first key (corpus size, index size, concurrency).
+            label = next(iter(item.items())) if isinstance(item, dict) and item else None
+            if label:
+                item = {key: value for key, value in item.items() if key != label[0]}
+            flat.update(flatten(item, f"{prefix}{label[0]}={label[1]}." if label else prefix))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        flat[prefix.rstrip(".")] = results
+    return flat
+
+
+def compare(previous, current):
+    """Prints every number that both runs measured, with the relative change."""
+    old, new = flatten({k: previous.get(k) for k in ("ingest", "faiss", "startup", "chat", "memory")}), \
+        flatten({k: current.get(k) for k in ("ingest", "faiss", "startup", "chat", "memory")})
+    print(f"\n{'metric':<48}{'before':>12}{'after':>12}{'change':>10}")
+    for key in sorted(set(old) & set(new)):
+        change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+        print(f"{key:<48}{old[key]:>12.3f}{new[key]:>12.3f}{change:>9.1f}%")
+
+
+def parse_sizes(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the multi-domain RAG pipeline.")
+    parser.add_argument("--latency-ms", type=float, default=50, help="simulated latency per API call")
+    parser.add_argument("--token-delay-ms", type=float, default=0, help="simulated delay per streamed token")
+    parser.add_argument("--embedding-dim", type=int, default=256, help="stub embedding size")
+    parser.add_argument("--corpus-sizes", type=parse_sizes, default=[20000, 100000, 400000],
+                        help="characters per domain for the ingest runs")
+    parser.add_argument("--faiss-sizes", type=parse_sizes, default=[1000, 10000, 100000],
+                        help="vectors in the index for the FAISS runs")
+    parser.add_argument("--faiss-queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=parse_sizes, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=48, help="/chat requests per concurrency level")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="results file (default: benchmark_results/pipeline-<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    stub, base_url = start_stub_server(args.latency_ms, args.token_delay_ms, args.embedding_dim)
+    # The app, its index and its domain files live in a scratch directory, so the
+    # stub vectors never mix with a real index and every run starts cold.
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    os.environ.update({
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_KEY": "stub",
+        # Cosine similarity never reaches 2, so every /chat request runs the chain.
+        "ANSWER_CACHE_THRESHOLD": "2",
+        # No tiktoken download for the app's embeddings either (see embedding_cache.py).
+        "EMBEDDING_CHECK_CTX_LENGTH": "false",
+        "DOMAIN_CONFIG": os.path.join(workdir, "domains.yaml"),
+    })
+    os.environ.pop("EMBEDDING_CACHE_PATH", None)
+    for name in ("domains.yaml", "dining.txt", "rooms.txt", "wellness.txt"):
+        shutil.copy(os.path.join(HERE, name), workdir)
+    sys.path.insert(0, HERE)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "memory": {"rss_mb_start": rss_mb()},
+    }
+    try:
+        print(f"Stub OpenAI server at {base_url}, {args.latency_ms:.0f}ms simulated latency.")
+        results["ingest"] = bench_ingest(workdir, args.corpus_sizes, args.seed)
+        results["memory"]["rss_mb_after_ingest"] = rss_mb()
+        results["faiss"] = bench_faiss(args.faiss_sizes, args.embedding_dim, args.faiss_queries, args.seed)
+        results["memory"]["rss_mb_after_faiss"] = rss_mb()
+        results["startup"] = bench_startup()
+        results["chat"] = bench_chat(args.concurrency, args.requests)
+        results["memory"]["rss_mb_after_chat"] = rss_mb()
+    finally:
+        os.chdir(cwd)
+        stub.terminate()
+        stub.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"pipeline-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output}.")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
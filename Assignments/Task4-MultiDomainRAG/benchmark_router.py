@@ -0,0 +1,78 @@
+# benchmark_router.py
+
+# ==============================================================================
+# Compare the LLM router with the local embedding routers
+# ==============================================================================
+# Runs a small labelled set of guest questions through each router and prints
+# routing accuracy, mean/p95 latency and how often the embedding routers had to
+# fall back to the LLM. The "keyword" and "cached" rows put router_cache.py in
+# front of the LLM router: the first pass only saves the keyword matches, the
+# second pass is served from the decision cache. Uses the same models and
+# indexes as app.py, so it needs the OpenAI API key from .env.
+#
+# Usage: python benchmark_router.py
+import time
+import statistics
+from app import get_pipeline
+from semantic_router import EmbeddingRouter
+from router_cache import CachedRouter, KeywordRouter
+
+LABELLED_QUESTIONS = [
+    ("What time is check-in?", "rooms"),
+    ("Can I check out late tomorrow?", "rooms"),
+    ("Do suites have a minibar?", "rooms"),
+    ("How often is housekeeping done?", "rooms"),
+    ("Which restaurant serves Pan-Asian food?", "dining"),
+    ("Until when is the Terrace Grill open?", "dining"),
+    ("Is breakfast included and when is it served?", "dining"),
+    ("Can I order food to my room at 2am?", "dining"),
+    ("Do you offer Ayurvedic massages?", "wellness"),
+    ("Is the gym open at night?", "wellness"),
+    ("When does the pool close?", "wellness"),
+    ("Where do I book a spa package?", "wellness"),
+    ("What is the weather like today?", "default"),
+    ("Can you recommend a good book?", "default"),
+    ("How far is the airport from the city centre?", "default"),
+    ("Who won the football match yesterday?", "default"),
+]
+
+
+def run_benchmark(name, route):
+    """Routes every labelled question and returns accuracy and latency figures."""
+    latencies = []
+    correct = 0
+    for question, expected in LABELLED_QUESTIONS:
+        start = time.perf_counter()
+        destination = route({"input": question})["destination"]
+        latencies.append((time.perf_counter() - start) * 1000)
+        correct += destination == expected
+    latencies.sort()
+    return {
+        "router": name,
+        "accuracy": correct / len(LABELLED_QUESTIONS),
+        "mean_ms": statistics.mean(latencies),
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+    }
+
+
+if __name__ == "__main__":
+    pipeline = get_pipeline()
+    results = [run_benchmark("llm", pipeline.router_chain.invoke)]
+    for mode in ("centroid", "index"):
+        router = EmbeddingRouter(pipeline.embeddings, fallback=pipeline.router_chain, mode=mode,
+                                 vector_stores=pipeline.vector_stores, exemplars=pipeline.domain_registry.exemplars())
+        result = run_benchmark(mode, router.route)
+        result["llm_fallbacks"] = router.fallbacks
+        results.append(result)
+
+    cached = CachedRouter(pipeline.router_chain, KeywordRouter(pipeline.domain_registry.keywords()))
+    for name in ("keyword", "cached"):
+        misses = cached.misses
+        result = run_benchmark(name, cached.route)
+        result["llm_fallbacks"] = cached.misses - misses
+        results.append(result)
+
+    print(f"{'router':<10}{'accuracy':>10}{'mean ms':>10}{'p95 ms':>10}{'fallbacks':>11}")
+    for r in results:
+        print(f"{r['router']:<10}{r['accuracy']:>10.2f}{r['mean_ms']:>10.1f}{r['p95_ms']:>10.1f}"
+              f"{r.get('llm_fallbacks', '-'):>11}")
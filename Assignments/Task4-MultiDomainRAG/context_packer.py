@@ -0,0 +1,76 @@
+# context_packer.py
+
+# ==============================================================================
+# Token-budgeted context packing for the stuff-documents chains
+# ==============================================================================
+# create_stuff_documents_chain concatenates every retrieved chunk into {context}.
+# With 500/100 chunking, neighbouring chunks repeat up to 100 characters of each
+# other, and a chunk may be retrieved together with a larger one containing it.
+# pack_documents walks the retrieved chunks in score order and:
+#   - skips chunks whose text is already contained in the packed context,
+#   - merges a chunk into an already packed chunk from the same source when
+#     one ends with the text the other starts with (their splitter overlap),
+#   - stops adding text once the token budget is spent.
+# Fewer prompt tokens mean lower latency and cost for the generation call.
+from langchain_core.documents import Document
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Counts tokens with the gpt-4o-mini tokenizer (falls back to chars / 4)."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+        except Exception:
+            _encoding = False
+    if _encoding is False:
+        return max(1, len(text) // 4)
+    return len(_encoding.encode(text))
+
+
+def merge_overlapping(first, second, min_overlap=20):
+    """
+    Joins two chunks whose ends overlap, in whichever order they overlap.
+    Returns None when they do not share at least `min_overlap` characters.
+    """
+    for a, b in ((first, second), (second, first)):
+        for size in range(min(len(a), len(b)), min_overlap - 1, -1):
+            if a.endswith(b[:size]):
+                return a + b[size:]
+    return None
+
+
+def pack_documents(docs, token_budget=1500, min_overlap=20):
+    """Returns deduplicated, merged documents that fit in `token_budget` tokens, in score order."""
+    packed = []
+    used = 0
+    for doc in docs:
+        text = doc.page_content
+        if any(text in p.page_content for p in packed):
+            continue
+
+        merged = False
+        for i, p in enumerate(packed):
+            if p.metadata.get("source") != doc.metadata.get("source"):
+                continue
+            combined = merge_overlapping(p.page_content, text, min_overlap)
+            if combined is None:
+                continue
+            extra = count_tokens(combined) - count_tokens(p.page_content)
+            if used + extra <= token_budget:
+                packed[i] = Document(page_content=combined, metadata=p.metadata)
+                used += extra
+            merged = True
+            break
+
+        if not merged:
+            cost = count_tokens(text)
+            # A lower-ranked, shorter chunk may still fit, so keep looking.
+            if used + cost > token_budget:
+                continue
+            packed.append(doc)
+            used += cost
+    return packed
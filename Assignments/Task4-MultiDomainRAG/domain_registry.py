@@ -0,0 +1,79 @@
+# domain_registry.py
+
+# ==============================================================================
+# Config-driven domain registry
+# ==============================================================================
+# The hotel departments (source file, prompt, routing description) are read from
+# domains.yaml (or a JSON file with the same layout) instead of being hard-coded
+# in app.py. The registry maps a router destination to its chains with a single
+# dict lookup, and builds a domain's chains only on the first request routed to
+# it, so startup cost does not grow with the number of departments.
+import json
+import threading
+import yaml
+
+REQUIRED_KEYS = ("source", "description")
+
+
+def load_domain_config(path):
+    """Reads {domain: settings} from a YAML or JSON file and checks the required keys."""
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f) if path.endswith(".json") else yaml.safe_load(f)
+
+    domains = (config or {}).get("domains") or {}
+    if not domains:
+        raise ValueError(f"No domains configured in {path}.")
+    for name, settings in domains.items():
+        missing = [key for key in REQUIRED_KEYS if not settings.get(key)]
+        if missing:
+            raise ValueError(f"Domain '{name}' in {path} is missing: {', '.join(missing)}.")
+        if name == "default":
+            raise ValueError(f"'default' is reserved for questions outside every domain ({path}).")
+    return domains
+
+
+class DomainRegistry:
+    """Domain settings plus their chains, built lazily and looked up by name."""
+
+    def __init__(self, domains, build_chains):
+        self.domains = domains
+        self._build_chains = build_chains
+        self._chains = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.domains
+
+    def names(self):
+        return list(self.domains)
+
+    def get(self, name):
+        """Returns the chains built for a domain, building them on first use."""
+        chains = self._chains.get(name)
+        if chains is None:
+            with self._lock:
+                chains = self._chains.get(name)
+                if chains is None:
+                    print(f"Building chains for domain '{name}'...")
+                    chains = self._build_chains(name, self.domains[name])
+                    self._chains[name] = chains
+        return chains
+
+    def source_files(self):
+        """Returns {domain: source file} for indexing."""
+        return {name: settings["source"] for name, settings in self.domains.items()}
+
+    def exemplars(self):
+        """Returns {domain: example questions} for the domains that define them."""
+        return {name: s["exemplars"] for name, s in self.domains.items() if s.get("exemplars")}
+
+    def keywords(self):
+        """Returns {domain: keyword patterns} for the domains that define them."""
+        return {name: s["keywords"] for name, s in self.domains.items() if s.get("keywords")}
+
+    def router_domain_list(self):
+        """Returns the numbered domain list used in the router prompt."""
+        return "\n".join(
+            f"{i}. {name}: {settings['description']}"
+            for i, (name, settings) in enumerate(self.domains.items(), start=1)
+        )
@@ -0,0 +1,200 @@
+# embedding_cache.py
+
+# ==============================================================================
+# Embedding cache in front of OpenAIEmbeddings
+# ==============================================================================
+# Every chunk at ingest and every question at query time goes through the
+# embeddings model. The same texts come back again and again (unchanged chunks,
+# repeated guest questions), so CachedEmbeddings keeps their vectors keyed by
+# (model, normalized text):
+#   - an in-memory LRU tier with a fixed number of entries, and
+#   - an optional SQLite file tier that survives restarts.
+# Only texts missing from both tiers are sent to the wrapped model, in a single
+# batched call. Hit/miss counters are kept so the cache can be sized.
+#
+# The apps get their embeddings from cached_openai_embeddings(), which sizes the
+# memory tier from EMBEDDING_CACHE_SIZE and enables the SQLite tier when
+# EMBEDDING_CACHE_PATH is set. EMBEDDING_CHECK_CTX_LENGTH=false sends texts
+# without tokenizing them first; OpenAIEmbeddings otherwise downloads the
+# tiktoken encoding on first use, which a machine without network access (a
+# stub server run, see benchmark_pipeline.py) cannot do.
+import os
+import re
+import time
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from tracing import record_stage, record_cache
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Collapses whitespace so trivially different texts share a cache entry."""
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings model with an LRU memory tier and an optional SQLite tier."""
+
+    def __init__(self, embeddings, max_entries=10000, cache_path=None):
+        self.embeddings = embeddings
+        # Expose the wrapped model name so index fingerprints stay the same.
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.max_entries = max_entries
+        self.cache_path = cache_path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if cache_path:
+            self._db = sqlite3.connect(cache_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, text))"
+            )
+            self._db.commit()
+
+    # --------------------------------------------------------------------------
+    # Cache tiers
+    # --------------------------------------------------------------------------
+    def _get_memory(self, key):
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+        return vector
+
+    def _put_memory(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _get_disk(self, key):
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT vector FROM embeddings WHERE model = ? AND text = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+        return array("f", row[0]).tolist()
+
+    def _put_disk(self, items):
+        if self._db is None or not items:
+            return
+        self._db.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, text, vector) VALUES (?, ?, ?)",
+            [(key[0], key[1], array("f", vector).tobytes()) for key, vector in items],
+        )
+        self._db.commit()
+
+    def _lookup(self, texts):
+        """Returns cached vectors (None for misses) and the keys still to embed."""
+        keys = [(self.model, normalize_text(text)) for text in texts]
+        vectors = []
+        missing = OrderedDict()
+        hits = 0
+        with self._lock:
+            for text, key in zip(texts, keys):
+                vector = self._get_memory(key)
+                if vector is not None:
+                    self.hits += 1
+                    hits += 1
+                else:
+                    vector = self._get_disk(key)
+                    if vector is not None:
+                        self.disk_hits += 1
+                        hits += 1
+                        self._put_memory(key, vector)
+                    else:
+                        self.misses += 1
+                        missing.setdefault(key, text)
+                vectors.append(vector)
+        record_cache("embedding", hits=hits, misses=len(texts) - hits)
+        return keys, vectors, missing
+
+    def _store(self, items):
+        with self._lock:
+            for key, vector in items:
+                self._put_memory(key, vector)
+            self._put_disk(items)
+
+    # --------------------------------------------------------------------------
+    # Embeddings interface
+    # --------------------------------------------------------------------------
+    def embed_documents(self, texts):
+        """Embeds a list of texts, calling the wrapped model only for cache misses."""
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            start = time.perf_counter()
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            record_stage("embedding", time.perf_counter() - start)
+            computed = dict(zip(missing.keys(), new_vectors))
+            self._store(list(computed.items()))
+            vectors = [v if v is not None else computed[k] for k, v in zip(keys, vectors)]
+        return vectors
+
+    def embed_query(self, text):
+        """Embeds a single query, served from the cache when it was seen before."""
+        keys, vectors, missing = self._lookup([text])
+        if missing:
+            start = time.perf_counter()
+            vector = self.embeddings.embed_query(text)
+            record_stage("embedding", time.perf_counter() - start)
+            self._store([(keys[0], vector)])
+            return vector
+        return vectors[0]
+
+    async def aembed_documents(self, texts):
+        """Async version of embed_documents."""
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            start = time.perf_counter()
+            new_vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            record_stage("embedding", time.perf_counter() - start)
+            computed = dict(zip(missing.keys(), new_vectors))
+            self._store(list(computed.items()))
+            vectors = [v if v is not None else computed[k] for k, v in zip(keys, vectors)]
+        return vectors
+
+    async def aembed_query(self, text):
+        """Async version of embed_query."""
+        keys, vectors, missing = self._lookup([text])
+        if missing:
+            start = time.perf_counter()
+            vector = await self.embeddings.aembed_query(text)
+            record_stage("embedding", time.perf_counter() - start)
+            self._store([(keys[0], vector)])
+            return vector
+        return vectors[0]
+
+    def stats(self):
+        """Returns hit/miss counters and the current memory tier size."""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "max_entries": self.max_entries,
+            }
+
+
+def cached_openai_embeddings(**client_kwargs):
+    """OpenAIEmbeddings(**client_kwargs) behind a CachedEmbeddings configured from the environment."""
+    check_ctx_length = os.getenv("EMBEDDING_CHECK_CTX_LENGTH", "true").lower() == "true"
+    return CachedEmbeddings(
+        OpenAIEmbeddings(check_embedding_ctx_length=check_ctx_length, **client_kwargs),
+        max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+        cache_path=os.getenv("EMBEDDING_CACHE_PATH"),
+    )
@@ -0,0 +1,130 @@
+# fetch_cache.py
+
+# ==============================================================================
+# On-disk conditional fetch cache for the URL-based apps
+# ==============================================================================
+# app2.py and app3.py used to download and parse every page on each start. The
+# cache keeps, per URL, the ETag / Last-Modified validators, a hash of the raw
+# response and the extracted text. The next fetch is a conditional request:
+#   - 304 Not Modified              -> the cached text is reused as is;
+#   - 200 with the same content hash -> the HTML parse is skipped as well;
+#   - 200 with new content           -> the page is parsed and the text replaced.
+# The text is saved as a plain file, so it can be passed to index_store.py like
+# any other source file: unchanged text keeps its fingerprint and the saved
+# index is reused without embedding anything; split_cached_pages turns those
+# files into chunks for load_or_build_index.
+#
+# Entries live in FETCH_CACHE_DIR and are keyed by URL within a `namespace`.
+# Apps that extract the same pages with different parsers (app2.py uses
+# unstructured, app3.py BeautifulSoup) pass different namespaces, so neither
+# reuses text the other's parser produced.
+import os
+import json
+import hashlib
+import threading
+import requests
+from langchain_core.documents import Document
+from ingest_pipeline import make_http_session, split_parallel
+
+FETCH_CACHE_DIR = os.getenv("FETCH_CACHE_DIR", "./fetch_cache")
+
+
+class FetchCache:
+    """Caches the extracted text of web pages and revalidates it with conditional GETs."""
+
+    def __init__(self, cache_dir=FETCH_CACHE_DIR, namespace="", session=None, timeout=30):
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        self.session = session or make_http_session()
+        self.timeout = timeout
+        self.fetched = 0
+        self.not_modified = 0
+        self.unchanged = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url):
+        key = hashlib.sha256(f"{self.namespace}\n{url}".encode("utf-8")).hexdigest()[:32]
+        base = os.path.join(self.cache_dir, key)
+        return base + ".json", base + ".txt"
+
+    def _read_entry(self, url):
+        entry_path, text_path = self._paths(url)
+        if not (os.path.exists(entry_path) and os.path.exists(text_path)):
+            return None
+        try:
+            with open(entry_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def fetch(self, url, extract):
+        """
+        Returns the path of a text file holding `extract(response)` for `url`.
+        `extract` only runs when the page content actually changed. If the
+        request fails and a cached copy exists, the cached copy is used.
+        """
+        entry_path, text_path = self._paths(url)
+        entry = self._read_entry(url)
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and entry:
+                self._count("not_modified")
+                return text_path
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if entry is None:
+                raise
+            print(f"Error fetching URL {url} ({e}), using the cached copy.")
+            return text_path
+
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        if entry and entry.get("content_hash") == content_hash:
+            self._count("unchanged")
+        else:
+            self._write(text_path, extract(response))
+            self._count("fetched")
+        self._write(entry_path, json.dumps({
+            "url": url,
+            "namespace": self.namespace,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_hash": content_hash,
+        }, indent=2))
+        return text_path
+
+    def stats(self):
+        """Counts of parsed pages, 304 answers and unchanged 200 answers."""
+        return {"fetched": self.fetched, "not_modified": self.not_modified, "unchanged": self.unchanged}
+
+
+def split_cached_pages(files, urls, chunk_size=500, chunk_overlap=100, processes=0):
+    """
+    Splits the cached page text of {domain: text file} into chunks per domain,
+    with the domain's page in `urls` as their source. Empty pages give no chunks.
+    """
+    docs = {}
+    for domain, path in files.items():
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+        docs[domain] = [Document(page_content=content, metadata={"source": urls[domain], "domain": domain})] if content else []
+    chunks = split_parallel(docs, chunk_size=chunk_size, chunk_overlap=chunk_overlap, processes=processes)
+    for domain, domain_chunks in chunks.items():
+        print(f"Loaded {len(domain_chunks)} chunks for {domain}.")
+    return chunks
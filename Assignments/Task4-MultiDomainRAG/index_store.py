@@ -0,0 +1,245 @@
+# index_store.py
+
+# ==============================================================================
+# Persistent FAISS index cache for the multi-domain assistant
+# ==============================================================================
+# Building a FAISS store with FAISS.from_documents sends every chunk through the
+# embeddings model. The chunks only change when the source file or the splitter
+# settings change, so we fingerprint those inputs and keep the saved index next
+# to the fingerprint. On the next start, if every domain's fingerprint still
+# matches, the index is opened from disk without any embedding calls.
+#
+# All domains share one index. Every chunk carries its domain in its metadata,
+# and multi_domain_index.py restricts searches to one domain.
+#
+# When a source file does change, the manifest also records a hash for every
+# chunk of every domain (used as its vector id in the docstore). The new split
+# is diffed against it so only added chunks are embedded and removed chunks are
+# deleted from the saved index, instead of re-embedding everything.
+#
+# Changed domains are loaded together and the added chunks are embedded in
+# batches that stream into the store (see ingest_pipeline.py).
+#
+# The index is saved as a read-only snapshot (see mmap_store.py) in its own
+# sub-folder, and the manifest names the current one. The app opens it through
+# memory maps, so a warm start maps the files instead of unpickling them and
+# every gunicorn worker shares the same pages. An update writes a new snapshot,
+# then the manifest (the commit point), then removes the old one. A lock file
+# makes concurrent workers wait for a single rebuild instead of racing.
+import os
+import json
+import uuid
+import shutil
+import hashlib
+from contextlib import contextmanager
+from langchain_community.vectorstores import FAISS
+from ingest_pipeline import embed_into_index
+from mmap_store import write_snapshot, open_snapshot
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, workers may rebuild twice.
+    fcntl = None
+
+# Root folder for the saved indexes.
+INDEX_ROOT = "./index"
+# Sub-folder of INDEX_ROOT holding the shared multi-domain index.
+INDEX_NAME = "all"
+MANIFEST_NAME = "manifest.json"
+
+
+def embeddings_model_name(embeddings):
+    """Returns a stable name for the embeddings model, used in fingerprints."""
+    return getattr(embeddings, "model", None) or type(embeddings).__name__
+
+
+def splitter_settings(chunk_size, chunk_overlap, model_name):
+    """Settings that, when changed, invalidate every chunk of an index."""
+    return {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "model": model_name}
+
+
+def fingerprint_source(file_path, settings):
+    """Hashes a source file together with the settings used to split and embed it."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        digest.update(f.read())
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def chunk_hash(chunk, domain):
+    """Content hash of a single chunk within its domain, also used as its vector id."""
+    return hashlib.sha256(f"{domain}\0{chunk.page_content}".encode("utf-8")).hexdigest()
+
+
+def hash_chunks(chunks, domain):
+    """
+    Tags chunks with their domain and maps chunk hash -> chunk, dropping
+    chunks whose text is an exact duplicate within the domain.
+    """
+    hashed = {}
+    for chunk in chunks:
+        chunk.metadata["domain"] = domain
+        hashed.setdefault(chunk_hash(chunk, domain), chunk)
+    return hashed
+
+
+def read_manifest(index_dir):
+    """Reads the manifest saved next to an index, or None if there is none."""
+    manifest_path = os.path.join(index_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(index_dir, manifest):
+    """Writes the manifest atomically so a crash never leaves half a file behind."""
+    manifest_path = os.path.join(index_dir, MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def index_version(domain, index_root=INDEX_ROOT):
+    """Returns the fingerprint of a domain in the saved index, or None if it has none."""
+    manifest = read_manifest(os.path.join(index_root, INDEX_NAME))
+    if not manifest:
+        return None
+    return manifest.get("domains", {}).get(domain, {}).get("fingerprint")
+
+
+@contextmanager
+def index_lock(index_dir):
+    """Holds an exclusive lock on an index folder across processes."""
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, ".lock"), "w") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_saved_index(index_dir, embeddings):
+    """Opens the current snapshot of a saved index, or returns None if there is none."""
+    manifest = read_manifest(index_dir)
+    if not manifest or not manifest.get("snapshot"):
+        return None
+    return open_snapshot(os.path.join(index_dir, manifest["snapshot"]), embeddings)
+
+
+def diff_chunks(hashed_chunks, manifest_chunks):
+    """
+    Compares a domain's new split with its manifest entry. Returns the hashes
+    to embed, the vector ids to delete, and the new chunk map.
+    """
+    removed = [manifest_chunks[h] for h in manifest_chunks if h not in hashed_chunks]
+    added = [h for h in hashed_chunks if h not in manifest_chunks]
+    chunk_map = {h: manifest_chunks[h] for h in hashed_chunks if h in manifest_chunks}
+    chunk_map.update({h: h for h in added})
+    return added, removed, chunk_map
+
+
+def load_or_build_index(domain_files, embeddings, load_chunks,
+                        chunk_size, chunk_overlap, index_root=INDEX_ROOT,
+                        batch_size=128, max_in_flight=4):
+    """
+    Returns the shared index for all domains in `domain_files` ({domain: file
+    path}) as a memory-mapped SnapshotStore, reusing the saved copy as far as
+    possible.
+
+    `load_chunks` takes {domain: file path} and returns {domain: chunks}. It is
+    only called with the domains whose source changed, so a cache hit skips
+    both the file split and the embedding round-trips. Changed domains are
+    patched chunk by chunk; domains removed from `domain_files` are deleted
+    from the index. New chunks are embedded `batch_size` at a time with at
+    most `max_in_flight` batches outstanding. Raises ValueError when the
+    sources give no chunks at all.
+    """
+    index_dir = os.path.join(index_root, INDEX_NAME)
+    settings = splitter_settings(chunk_size, chunk_overlap, embeddings_model_name(embeddings))
+    fingerprints = {d: fingerprint_source(path, settings) for d, path in domain_files.items()}
+
+    with index_lock(index_dir):
+        manifest = read_manifest(index_dir)
+        if manifest and manifest.get("settings") != settings:
+            print("Splitter or embedding settings changed, rebuilding the index...")
+            manifest = None
+
+        old_domains = manifest.get("domains", {}) if manifest else {}
+        unchanged = {d for d, fp in fingerprints.items() if old_domains.get(d, {}).get("fingerprint") == fp}
+        snapshot_name = manifest.get("snapshot") if manifest else None
+        if snapshot_name and unchanged == set(fingerprints) and set(old_domains) == set(fingerprints):
+            try:
+                snapshot = open_snapshot(os.path.join(index_dir, snapshot_name), embeddings)
+                print(f"Opened cached index for {', '.join(fingerprints)} from {index_dir}.")
+                return snapshot
+            except Exception as e:
+                print(f"Could not open cached index ({e}), rebuilding...")
+                manifest, old_domains, unchanged = None, {}, set()
+
+        store = None
+        if manifest:
+            try:
+                if snapshot_name:
+                    store = open_snapshot(os.path.join(index_dir, snapshot_name), embeddings).to_faiss_store()
+                else:
+                    # Index saved by an older version with save_local; converted to a snapshot below.
+                    store = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+            except Exception as e:
+                # A damaged index is not fatal, we simply rebuild it below.
+                print(f"Could not load cached index ({e}), rebuilding...")
+                old_domains, unchanged = {}, set()
+
+        new_domains = {d: old_domains[d] for d in domain_files if d in unchanged}
+        changed_files = {d: path for d, path in domain_files.items() if d not in unchanged}
+        loaded = load_chunks(changed_files) if changed_files else {}
+        added_docs, added_ids, removed_ids = [], [], []
+        for domain, file_path in changed_files.items():
+            hashed_chunks = hash_chunks(loaded[domain], domain)
+            old_chunks = old_domains.get(domain, {}).get("chunks", {})
+            added, removed, chunk_map = diff_chunks(hashed_chunks, old_chunks)
+            added_docs += [hashed_chunks[h] for h in added]
+            added_ids += added
+            removed_ids += removed
+            new_domains[domain] = {"source": file_path, "fingerprint": fingerprints[domain], "chunks": chunk_map}
+            print(f"'{domain}': {len(added)} chunks to embed, {len(removed)} to remove, "
+                  f"{len(hashed_chunks) - len(added)} reused.")
+
+        for domain in set(old_domains) - set(domain_files):
+            removed_ids += list(old_domains[domain]["chunks"].values())
+            print(f"'{domain}' is no longer configured, removing its chunks.")
+
+        if store is None:
+            print("Building FAISS index for all domains...")
+        else:
+            print("Updating FAISS index incrementally...")
+            if removed_ids:
+                store.delete(removed_ids)
+        if added_docs:
+            store, _ = embed_into_index(store, added_docs, embeddings, ids=added_ids,
+                                        batch_size=batch_size, max_in_flight=max_in_flight)
+
+        if store is None or store.index.ntotal == 0:
+            raise ValueError(f"No text to index: {', '.join(domain_files) or 'no domains'} produced no chunks. "
+                             "Check that the sources exist and are not empty.")
+
+        snapshot_name = f"snapshot-{uuid.uuid4().hex[:12]}"
+        write_snapshot(store, os.path.join(index_dir, snapshot_name))
+        write_manifest(index_dir, {"settings": settings, "snapshot": snapshot_name, "domains": new_domains})
+        # Old snapshots and files of the pickled format are no longer referenced.
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            if name.startswith("snapshot-") and name != snapshot_name:
+                shutil.rmtree(path, ignore_errors=True)
+            elif name in ("index.faiss", "index.pkl"):
+                os.remove(path)
+        print(f"Saved index snapshot to {os.path.join(index_dir, snapshot_name)}.")
+        return open_snapshot(os.path.join(index_dir, snapshot_name), embeddings)
@@ -0,0 +1,125 @@
+# ingest_pipeline.py
+
+# ==============================================================================
+# Parallel document ingestion: load, split, embed and index
+# ==============================================================================
+# The apps used to fetch or read each domain's source one after another, split
+# everything, and then embed all chunks in one blocking call before FAISS could
+# be built. The helpers below overlap those steps:
+#   - load_concurrently runs the per-domain loaders (file reads, HTTP fetches)
+#     in a thread pool; make_http_session gives them one pooled requests session
+#     so connections are reused;
+#   - split_parallel splits each domain's documents, optionally in a process
+#     pool for large corpora;
+#   - embed_into_index embeds chunks in fixed-size batches with a bounded number
+#     of batches in flight, and adds every batch to the FAISS store as soon as
+#     its vectors arrive.
+# Each step reports its throughput. Loaders, sessions and the embeddings object
+# are passed in, so a local HTTP fixture server and a fake embedder can be used
+# in tests.
+import time
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from langchain_community.vectorstores import FAISS
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+
+def make_http_session(pool_size=10):
+    """Returns a requests session whose connection pool is shared by all fetches."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": "Mozilla/5.0"})
+    return session
+
+
+def load_concurrently(loaders, max_workers=8):
+    """
+    Runs {key: zero-argument loader} in a thread pool and returns {key: result}.
+    A loader that raises propagates its exception, like a sequential loop would.
+    """
+    start = time.perf_counter()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(loader): key for key, loader in loaders.items()}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    print(f"Loaded {len(results)} sources in {time.perf_counter() - start:.2f}s.")
+    return results
+
+
+def _split(args):
+    documents, chunk_size, chunk_overlap = args
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return splitter.split_documents(documents)
+
+
+def split_parallel(documents_by_key, chunk_size, chunk_overlap, processes=0):
+    """
+    Splits {key: [Document]} into {key: [chunk]}. With processes > 0 the keys are
+    split in a process pool (forked where the platform supports it, so the app
+    module is not imported again in the workers); otherwise in this process.
+    """
+    start = time.perf_counter()
+    keys = list(documents_by_key)
+    jobs = [(documents_by_key[key], chunk_size, chunk_overlap) for key in keys]
+    if processes and len(jobs) > 1:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+            results = list(pool.map(_split, jobs))
+    else:
+        results = [_split(job) for job in jobs]
+    chunks = dict(zip(keys, results))
+    total = sum(len(c) for c in results)
+    print(f"Split into {total} chunks in {time.perf_counter() - start:.2f}s.")
+    return chunks
+
+
+def embed_into_index(store, documents, embeddings, ids=None, batch_size=128, max_in_flight=4):
+    """
+    Embeds documents in batches of `batch_size`, with at most `max_in_flight`
+    batches being embedded at once, and adds each batch to `store` as soon as
+    it is ready. Creates the store from the first batch when `store` is None.
+    Returns (store, stats) where stats reports chunks per second.
+    """
+    start = time.perf_counter()
+    ids = ids or [None] * len(documents)
+    batches = [
+        (documents[i:i + batch_size], ids[i:i + batch_size])
+        for i in range(0, len(documents), batch_size)
+    ]
+
+    def embed(batch):
+        docs, _ = batch
+        return embeddings.embed_documents([d.page_content for d in docs])
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        # Each batch runs in a copy of the caller's context (e.g. its rate limit priority).
+        futures = {pool.submit(contextvars.copy_context().run, embed, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            docs, batch_ids = futures[future]
+            pairs = list(zip([d.page_content for d in docs], future.result()))
+            metadatas = [d.metadata for d in docs]
+            batch_ids = batch_ids if all(batch_ids) else None
+            if store is None:
+                store = FAISS.from_embeddings(pairs, embeddings, metadatas=metadatas, ids=batch_ids)
+            else:
+                store.add_embeddings(pairs, metadatas=metadatas, ids=batch_ids)
+            done += len(docs)
+
+    seconds = time.perf_counter() - start
+    stats = {
+        "chunks": done,
+        "batches": len(batches),
+        "seconds": seconds,
+        "chunks_per_second": done / seconds if seconds > 0 else 0.0,
+    }
+    print(f"Embedded {done} chunks in {len(batches)} batches "
+          f"({stats['chunks_per_second']:.1f} chunks/s).")
+    return store, stats
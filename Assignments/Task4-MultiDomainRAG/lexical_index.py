@@ -0,0 +1,121 @@
+# lexical_index.py
+
+# ==============================================================================
+# In-process BM25 index for hybrid retrieval
+# ==============================================================================
+# Dense retrieval needs the question's embedding, and it is not the best tool for
+# exact terms ("Aurora restaurant hours", "Terrace Grill"). A LexicalIndex holds
+# BM25 postings for the chunks of one domain as flat numpy arrays (CSR layout:
+# per term, the sorted chunk ids containing it and the term counts), so a query
+# costs one vectorized update per query term. index_store.py builds one per
+# domain when it writes the index snapshot; multi_domain_index.py fuses its
+# ranking with the vector ranking by reciprocal-rank fusion.
+#
+# search() also returns a confidence for the lexical result: the IDF-weighted
+# share of the query's terms that the top chunk contains. Terms that appear
+# nowhere in the domain count with the highest possible IDF, so a question
+# with words the domain has never seen never looks confident.
+import re
+import math
+import numpy as np
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by can could do does for from have how i if in is it me my "
+    "of on or our please the there this to up was we what when where which who why "
+    "will with would you your".split()
+)
+
+
+def tokenize(text):
+    """Lower-cased alphanumeric terms of a text, without stopwords."""
+    return [term for term in TOKEN_RE.findall(text.lower()) if term not in STOPWORDS]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuses ranked id lists: each id scores sum(1 / (k + rank)); returns ids best first."""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class LexicalIndex:
+    """BM25 over a list of texts, searched by position in that list."""
+
+    def __init__(self, terms, term_offsets, doc_ids, term_freqs, doc_lengths, k1=1.5, b=0.75):
+        self.terms = terms
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        n = len(doc_lengths)
+        self.avg_length = float(doc_lengths.mean()) if n else 0.0
+        df = np.diff(term_offsets).astype("float32")
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5))
+        # IDF of a term no text contains, used for unknown query terms.
+        self.max_idf = math.log1p((n + 0.5) / 0.5)
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts, **kwargs):
+        """Tokenizes `texts` and builds their postings."""
+        tokens = [tokenize(text) for text in texts]
+        lengths = np.array([len(t) for t in tokens], dtype="int64")
+        vocabulary = {}
+        term_of = np.fromiter((vocabulary.setdefault(token, len(vocabulary)) for doc in tokens for token in doc),
+                              dtype="int64", count=int(lengths.sum()))
+        # One (term, doc) key per token; unique keys come out sorted by term, then doc.
+        n = max(len(texts), 1)
+        keys, counts = np.unique(term_of * n + np.repeat(np.arange(len(texts)), lengths), return_counts=True)
+        term_offsets = np.zeros(len(vocabulary) + 1, dtype="int64")
+        np.cumsum(np.bincount(keys // n, minlength=len(vocabulary)), out=term_offsets[1:])
+        return cls(list(vocabulary), term_offsets, (keys % n).astype("int32"), counts.astype("float32"),
+                   lengths.astype("float32"), **kwargs)
+
+    def save(self, path):
+        np.savez(path, terms=np.array(self.terms, dtype="U"), term_offsets=self.term_offsets,
+                 doc_ids=self.doc_ids, term_freqs=self.term_freqs, doc_lengths=self.doc_lengths)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with np.load(path) as data:
+            return cls(data["terms"].tolist(), data["term_offsets"], data["doc_ids"],
+                       data["term_freqs"], data["doc_lengths"], **kwargs)
+
+    def search(self, query, k=4):
+        """
+        Returns (ids, scores, confidence) for the k best-scoring texts. Texts that
+        share no term with the query are left out, so fewer than k may come back.
+        """
+        query_terms = set(tokenize(query))
+        known = [self.vocabulary[t] for t in query_terms if t in self.vocabulary]
+        if not known or not len(self):
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32"), 0.0
+
+        scores = np.zeros(len(self), dtype="float32")
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / max(self.avg_length, 1e-9))
+        for term in known:
+            start, end = self.term_offsets[term], self.term_offsets[term + 1]
+            docs, tf = self.doc_ids[start:end], self.term_freqs[start:end]
+            scores[docs] += self.idf[term] * tf * (self.k1 + 1) / (tf + norm[docs])
+
+        k = min(k, int((scores > 0).sum()))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        # Share of the query's IDF mass whose terms occur in the best text.
+        best, matched = top[0], 0.0
+        for term in known:
+            docs = self.doc_ids[self.term_offsets[term]:self.term_offsets[term + 1]]
+            position = np.searchsorted(docs, best)
+            if position < len(docs) and docs[position] == best:
+                matched += self.idf[term]
+        total = float(sum(self.idf[t] for t in known)) + self.max_idf * (len(query_terms) - len(known))
+        return top.astype("int64"), scores[top], matched / total if total else 0.0
@@ -0,0 +1,159 @@
+# mmap_store.py
+
+# ==============================================================================
+# Read-only, memory-mapped snapshot of the shared index
+# ==============================================================================
+# FAISS.load_local reads the whole index and unpickles every document into each
+# process that imports app.py, so N gunicorn workers hold N private copies.
+# faiss's IO_FLAG_MMAP does not help here: it only maps IVF inverted lists, and
+# a flat index is still copied into memory. Instead, index_store.py writes the
+# index once into a plain file layout that every worker maps read-only, so all
+# of them share the same pages through the OS page cache:
+#   vectors.npy    float32 [n, dim], grouped so each domain is one contiguous
+#                  block; a domain search is a single matrix product over it
+#   sq_norms.npy   float32 [n], squared vector norms for L2 distances
+#   ids.npy        fixed-width bytes [n], the docstore id of every vector
+#   offsets.npy    int64 [n + 1], where each record starts in docs.bin
+#   docs.bin       one UTF-8 JSON [text, metadata] record per vector
+#   lexical-N.npz  BM25 postings of the N-th domain (see lexical_index.py)
+#   snapshot.json  dimension, metric and the [start, end) rows of every domain
+# Opening a snapshot maps the files and reads every domain's BM25 postings; a
+# document is decoded when a search returns it. Nothing is opened later, because
+# a rebuild in another process deletes superseded snapshot directories: mapped
+# files stay readable after that, but a file opened afterwards would be missing.
+import os
+import mmap
+import json
+import shutil
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from lexical_index import LexicalIndex
+
+
+def write_snapshot(store, directory):
+    """Writes a LangChain FAISS store as a snapshot directory, grouped by domain."""
+    ntotal = store.index.ntotal
+    doc_ids = [store.index_to_docstore_id[i] for i in range(ntotal)]
+    docs = [store.docstore.search(doc_id) for doc_id in doc_ids]
+    domains = [doc.metadata.get("domain") if isinstance(doc, Document) else None for doc in docs]
+
+    # Stable sort by domain; untagged vectors go last and belong to no domain.
+    names = sorted({d for d in domains if d is not None})
+    rank = {d: i for i, d in enumerate(names)}
+    order = sorted(range(ntotal), key=lambda i: rank.get(domains[i], len(names)))
+    ranges, start = {}, 0
+    for name in names:
+        count = sum(1 for d in domains if d == name)
+        ranges[name] = [start, start + count]
+        start += count
+
+    tmp_dir = directory + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    vectors = store.index.reconstruct_n(0, ntotal)[order] if ntotal else np.zeros((0, store.index.d), "float32")
+    np.save(os.path.join(tmp_dir, "vectors.npy"), vectors)
+    np.save(os.path.join(tmp_dir, "sq_norms.npy"), (vectors ** 2).sum(axis=1).astype("float32"))
+    np.save(os.path.join(tmp_dir, "ids.npy"), np.array([doc_ids[i].encode("utf-8") for i in order], dtype="S"))
+
+    offsets = [0]
+    with open(os.path.join(tmp_dir, "docs.bin"), "wb") as f:
+        for i in order:
+            record = json.dumps([docs[i].page_content, docs[i].metadata]).encode("utf-8")
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), np.array(offsets, dtype="int64"))
+
+    lexical = {}
+    for i, (name, (start, end)) in enumerate(ranges.items()):
+        lexical[name] = f"lexical-{i}.npz"
+        LexicalIndex.build([docs[j].page_content for j in order[start:end]]).save(os.path.join(tmp_dir, lexical[name]))
+
+    with open(os.path.join(tmp_dir, "snapshot.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "count": ntotal,
+            "dim": store.index.d,
+            "metric": "ip" if store.index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2",
+            "normalize_L2": store._normalize_L2,
+            "domains": ranges,
+            "lexical": lexical,
+        }, f, indent=2)
+    os.rename(tmp_dir, directory)
+
+
+class SnapshotStore:
+    """A snapshot directory opened read-only through memory maps."""
+
+    def __init__(self, directory, embeddings):
+        self.directory = directory
+        self.embeddings = embeddings
+        with open(os.path.join(directory, "snapshot.json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        self.ntotal = info["count"]
+        self.dim = info["dim"]
+        self.metric = info["metric"]
+        # Same attribute name as the LangChain FAISS store, so callers can treat both alike.
+        self._normalize_L2 = info["normalize_L2"]
+        self.domain_ranges = {d: tuple(r) for d, r in info["domains"].items()}
+        self._lexical = {d: LexicalIndex.load(os.path.join(directory, name))
+                         for d, name in info.get("lexical", {}).items()}
+
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        self.sq_norms = np.load(os.path.join(directory, "sq_norms.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "docs.bin"), "rb") as f:
+            self._docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        self._positions = None
+
+    def doc_id(self, position):
+        return self.ids[position].decode("utf-8")
+
+    def document(self, position):
+        """Decodes the document stored at a row of the snapshot."""
+        text, metadata = json.loads(self._docs[self.offsets[position]:self.offsets[position + 1]])
+        return Document(page_content=text, metadata=metadata)
+
+    def positions_of(self, doc_ids):
+        """Maps docstore ids to snapshot rows (the lookup table is built on first use)."""
+        if self._positions is None:
+            self._positions = {self.doc_id(i): i for i in range(self.ntotal)}
+        return [self._positions[doc_id] for doc_id in doc_ids]
+
+    def lexical_index(self, domain):
+        """The domain's BM25 index, or None for snapshots written without one."""
+        return self._lexical.get(domain)
+
+    def search_range(self, start, end, queries, k):
+        """Exact k-NN over rows [start, end); returns (distances, rows) like faiss search."""
+        k = min(k, end - start)
+        if k <= 0:
+            empty = np.zeros((len(queries), 0))
+            return empty.astype("float32"), empty.astype("int64")
+        scores = queries @ self.vectors[start:end].T
+        if self.metric == "l2":
+            distances = self.sq_norms[start:end][None, :] - 2 * scores + (queries ** 2).sum(axis=1, keepdims=True)
+            ranking = distances
+        else:
+            distances, ranking = scores, -scores
+        top = np.argpartition(ranking, k - 1, axis=1)[:, :k]
+        top = np.take_along_axis(top, np.argsort(np.take_along_axis(ranking, top, axis=1), axis=1), axis=1)
+        return np.take_along_axis(distances, top, axis=1), top + start
+
+    def to_faiss_store(self):
+        """Loads the snapshot into an in-memory LangChain FAISS store, for updating it."""
+        metric = faiss.METRIC_INNER_PRODUCT if self.metric == "ip" else faiss.METRIC_L2
+        index = faiss.IndexFlat(self.dim, metric)
+        if self.ntotal:
+            index.add(np.ascontiguousarray(self.vectors))
+        doc_ids = [self.doc_id(i) for i in range(self.ntotal)]
+        docstore = InMemoryDocstore({doc_id: self.document(i) for i, doc_id in enumerate(doc_ids)})
+        return FAISS(self.embeddings, index, docstore, dict(enumerate(doc_ids)),
+                     normalize_L2=self._normalize_L2)
+
+
+def open_snapshot(directory, embeddings):
+    """Opens a snapshot directory written by write_snapshot."""
+    return SnapshotStore(directory, embeddings)
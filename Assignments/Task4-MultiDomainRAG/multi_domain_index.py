@@ -0,0 +1,390 @@
+# multi_domain_index.py
+
+# ==============================================================================
+# Domain-filtered search over the shared FAISS index
+# ==============================================================================
+# All domains live in one FAISS store (see index_store.py), so memory and
+# loading cost stay at one index however many domains are configured. To search
+# a single domain we precompute, for every domain, a bitmap over FAISS's
+# internal vector ids and pass it to the search as an IDSelectorBitmap. FAISS
+# then skips other domains' vectors during the scan instead of us over-fetching
+# and post-filtering the results.
+#
+# The index opened from disk is a memory-mapped snapshot (see mmap_store.py)
+# whose vectors are stored grouped by domain. There a domain is just a range of
+# rows, which is searched directly without bitmaps; the bitmap path remains for
+# in-memory LangChain FAISS stores.
+#
+# MultiDomainIndex.view(domain) returns an object with the subset of the FAISS
+# vector store API used by the app (similarity_search_by_vector,
+# similarity_search_with_score_by_vector, as_retriever), so routers and
+# retrieval code can treat each domain like its own store.
+#
+# Large domains can instead be searched through their own approximate index,
+# configured per domain with an 'index' block in domains.yaml:
+#   type             flat (default) | ivf_flat | hnsw | ivf_pq
+#   nlist, nprobe    IVF lists to train and to visit per query
+#   m, ef_construction, ef_search
+#                    HNSW graph degree, build and search beam width
+#   pq_m, pq_bits    IVF-PQ sub-quantizers and bits per code; vectors are kept
+#                    as pq_m * pq_bits / 8 byte codes instead of 4 * dim bytes
+# The approximate index is trained on the domain's vectors from the shared
+# index and saved under `cache_dir`, keyed by the domain's chunk ids and the
+# settings, so it is only trained again when the domain or its settings
+# change. Loading and training hold the folder's index_lock (index_store.py),
+# so of several processes starting together only one trains. See
+# benchmark_ann.py for the recall-vs-latency trade-off.
+#
+# DomainView.as_hybrid_retriever() combines the vector search with the domain's
+# BM25 index (lexical_index.py) by reciprocal-rank fusion. When the best BM25
+# chunk contains (nearly) every term of the question, the lexical ranking is
+# used alone and the question is never embedded.
+import os
+import re
+import json
+import time
+import hashlib
+from typing import Any, List
+import faiss
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from index_store import index_lock
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from tracing import record_stage, record_cache
+
+
+def build_ann_index(vectors, settings, metric=faiss.METRIC_L2):
+    """
+    Builds and trains an approximate FAISS index over `vectors` as described by
+    `settings`. Returns None when there are too few vectors to train it.
+    """
+    kind = settings.get("type", "flat")
+    n, dim = vectors.shape
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, settings.get("m", 32), metric)
+        index.hnsw.efConstruction = settings.get("ef_construction", 80)
+    elif kind in ("ivf_flat", "ivf_pq"):
+        nlist = settings.get("nlist") or max(1, int(4 * n ** 0.5))
+        pq_m, pq_bits = settings.get("pq_m", 16), settings.get("pq_bits", 8)
+        if n < nlist or (kind == "ivf_pq" and n < 2 ** pq_bits):
+            return None
+        quantizer = faiss.IndexFlat(dim, metric)
+        if kind == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, metric)
+        else:
+            if dim % pq_m:
+                raise ValueError(f"pq_m={pq_m} must divide the embedding size {dim}.")
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_bits, metric)
+        index.train(vectors)
+    else:
+        raise ValueError(f"Unknown index type: {kind}")
+    index.add(vectors)
+    return index
+
+
+def ann_search_parameters(settings):
+    """Search-time knobs (nprobe or efSearch) for an index built by build_ann_index."""
+    if settings.get("type") == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=settings.get("ef_search", 64))
+    return faiss.SearchParametersIVF(nprobe=settings.get("nprobe", 8))
+
+
+class MultiDomainIndex:
+    """One store holding every domain, searchable per domain through id bitmaps or row ranges."""
+
+    def __init__(self, store, index_settings=None, cache_dir=None):
+        self.store = store
+        self.index_settings = index_settings or {}
+        self.cache_dir = cache_dir
+        self.refresh()
+
+    def refresh(self):
+        """Recomputes the id -> domain array and per-domain bitmaps after the index changed."""
+        self.ranges = getattr(self.store, "domain_ranges", None)
+        if self.ranges is not None:
+            # Snapshot: every domain is a contiguous block of rows.
+            self.domains = sorted(self.ranges)
+            codes = {d: i for i, d in enumerate(self.domains)}
+            self.domain_codes = np.full(self.store.ntotal, -1, dtype="int16")
+            for d, (start, end) in self.ranges.items():
+                self.domain_codes[start:end] = codes[d]
+            self.bitmaps = {}
+            self.counts = {d: end - start for d, (start, end) in self.ranges.items()}
+        else:
+            ntotal = self.store.index.ntotal
+            domain_of = []
+            for i in range(ntotal):
+                doc = self.store.docstore.search(self.store.index_to_docstore_id[i])
+                domain_of.append(doc.metadata.get("domain") if isinstance(doc, Document) else None)
+
+            self.domains = sorted({d for d in domain_of if d is not None})
+            codes = {d: i for i, d in enumerate(self.domains)}
+            # id -> domain code (-1 for untagged vectors), one int16 per vector.
+            self.domain_codes = np.array([codes.get(d, -1) for d in domain_of], dtype="int16")
+            # FAISS reads bit i of the bitmap (little-endian bit order) as "id i is allowed".
+            self.bitmaps = {
+                d: np.packbits(self.domain_codes == code, bitorder="little")
+                for d, code in codes.items()
+            }
+            self.counts = {d: int((self.domain_codes == code).sum()) for d, code in codes.items()}
+
+        # BM25 indexes, taken from the snapshot (or built for in-memory stores) on a
+        # domain's first lexical search.
+        self._lexical = {}
+
+        # Approximate indexes for the domains configured with one:
+        # {domain: (faiss index, store ids in index order, settings)}.
+        self.ann = {}
+        for domain, settings in self.index_settings.items():
+            if domain in codes and settings.get("type", "flat") != "flat":
+                ann = self._load_or_build_ann(domain, np.flatnonzero(self.domain_codes == codes[domain]), settings)
+                if ann is not None:
+                    self.ann[domain] = ann
+
+    def _doc_id(self, i):
+        if self.ranges is not None:
+            return self.store.doc_id(i)
+        return self.store.index_to_docstore_id[i]
+
+    def _document(self, i):
+        if self.ranges is not None:
+            return self.store.document(i)
+        return self.store.docstore.search(self.store.index_to_docstore_id[i])
+
+    def _positions(self, doc_ids):
+        """Maps docstore ids back to the store's current vector ids."""
+        if self.ranges is not None:
+            return self.store.positions_of(doc_ids)
+        position = {doc_id: i for i, doc_id in self.store.index_to_docstore_id.items()}
+        return [position[doc_id] for doc_id in doc_ids]
+
+    def _load_or_build_ann(self, domain, ids, settings):
+        # Cached indexes are keyed by docstore ids, which survive a rebuild of the
+        # shared index; the vector ids they map to are looked up again on load.
+        doc_ids = [self._doc_id(int(i)) for i in ids]
+        key = hashlib.sha256(json.dumps([sorted(doc_ids), settings], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        if not self.cache_dir:
+            return self._train_ann(domain, ids, settings)
+        # gunicorn workers start together: the first one trains and saves the index
+        # while the others wait on the lock, then load it.
+        with index_lock(self.cache_dir):
+            path = os.path.join(self.cache_dir, f"{domain}-{key}")
+            if os.path.exists(path + ".faiss") and os.path.exists(path + ".json"):
+                with open(path + ".json", "r", encoding="utf-8") as f:
+                    positions = np.array(self._positions(json.load(f)), dtype="int64")
+                return faiss.read_index(path + ".faiss"), positions, settings
+
+            ann = self._train_ann(domain, ids, settings)
+            if ann is None:
+                return None
+            # Drop this domain's stale indexes, never the current one. The key is 16 hex
+            # digits, so a file of a domain whose name merely starts with this one
+            # ("rooms-vip") never matches.
+            stale = re.compile(re.escape(domain) + r"-(?!" + key + r"\.)[0-9a-f]{16}\.(faiss|json)")
+            for name in os.listdir(self.cache_dir):
+                if stale.fullmatch(name):
+                    os.remove(os.path.join(self.cache_dir, name))
+            # Written under temporary names and renamed, so no file is ever seen half written.
+            faiss.write_index(ann[0], path + ".faiss.tmp")
+            os.replace(path + ".faiss.tmp", path + ".faiss")
+            with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+                json.dump(doc_ids, f)
+            os.replace(path + ".json.tmp", path + ".json")
+            return ann
+
+    def _train_ann(self, domain, ids, settings):
+        print(f"Training {settings['type']} index for '{domain}' ({len(ids)} vectors)...")
+        if self.ranges is not None:
+            vectors = np.ascontiguousarray(self.store.vectors[ids], dtype="float32")
+            metric = faiss.METRIC_INNER_PRODUCT if self.store.metric == "ip" else faiss.METRIC_L2
+        else:
+            vectors = self.store.index.reconstruct_batch(ids.astype("int64"))
+            metric = self.store.index.metric_type
+        index = build_ann_index(vectors, settings, metric)
+        if index is None:
+            print(f"Too few vectors in '{domain}' to train its {settings['type']} index, keeping exact search.")
+            return None
+        return index, ids.astype("int64"), settings
+
+    def search_parameters(self, domain):
+        """Builds FAISS search parameters that only admit the given domain's vectors."""
+        bitmap = self.bitmaps[domain]
+        # The first argument is the bitmap size in bytes.
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+        params = faiss.SearchParameters(sel=selector)
+        # Keep the selector alive as long as the parameters are in use.
+        params.selector_ref = selector
+        return params
+
+    def search(self, domain, embedding, k=4):
+        """Returns [(Document, distance)] for the k nearest chunks of one domain."""
+        return self.search_batch(domain, [embedding], k)[0]
+
+    def search_rows(self, domain, embeddings, k=4):
+        """
+        Searches one domain for a whole matrix of query embeddings in a single
+        call. Returns (distances, ids) arrays, with -1 ids for missing results.
+        """
+        k = min(k, self.counts.get(domain, 0))
+        if k == 0 or len(embeddings) == 0:
+            return np.zeros((len(embeddings), 0), dtype="float32"), np.zeros((len(embeddings), 0), dtype="int64")
+        queries = np.array(embeddings, dtype="float32")
+        if self.store._normalize_L2:
+            faiss.normalize_L2(queries)
+        start = time.perf_counter()
+        if domain in self.ann:
+            index, positions, settings = self.ann[domain]
+            distances, ids = index.search(queries, k, params=ann_search_parameters(settings))
+            ids = np.where(ids == -1, -1, positions[ids])
+        elif self.ranges is not None:
+            distances, ids = self.store.search_range(*self.ranges[domain], queries, k)
+        else:
+            distances, ids = self.store.index.search(queries, k, params=self.search_parameters(domain))
+        record_stage("faiss_search", time.perf_counter() - start)
+        return distances, ids
+
+    def search_batch(self, domain, embeddings, k=4):
+        """Searches one domain for a whole matrix of query embeddings in a single FAISS call."""
+        distances, ids = self.search_rows(domain, embeddings, k)
+        results = []
+        for row_distances, row_ids in zip(distances, ids):
+            row = []
+            for distance, i in zip(row_distances, row_ids):
+                if i == -1:
+                    continue
+                row.append((self._document(int(i)), float(distance)))
+            results.append(row)
+        return results
+
+    def documents(self, ids):
+        """The documents stored under the given vector ids."""
+        return [self._document(int(i)) for i in ids]
+
+    def lexical_index(self, domain):
+        """The domain's BM25 index and the vector ids of its texts, loaded or built on first use."""
+        entry = self._lexical.get(domain)
+        if entry is None:
+            if self.ranges is not None:
+                start, end = self.ranges[domain]
+                rows = np.arange(start, end)
+                index = self.store.lexical_index(domain)
+            else:
+                rows, index = np.flatnonzero(self.domain_codes == self.domains.index(domain)), None
+            if index is None:
+                # In-memory stores and older snapshots have no saved postings.
+                index = LexicalIndex.build([self._document(int(i)).page_content for i in rows])
+            entry = self._lexical[domain] = (index, rows)
+        return entry
+
+    def lexical_search(self, domain, query, k=4):
+        """Returns (vector ids, confidence) of the BM25 top-k of one domain."""
+        if domain not in self.counts:
+            return np.zeros(0, dtype="int64"), 0.0
+        start = time.perf_counter()
+        index, rows = self.lexical_index(domain)
+        ids, _, confidence = index.search(query, k)
+        record_stage("bm25_search", time.perf_counter() - start)
+        return rows[ids], confidence
+
+    def view(self, domain):
+        """Returns a store-like view restricted to one domain."""
+        return DomainView(self, domain)
+
+
+class DomainView:
+    """Vector-store-like access to one domain of a MultiDomainIndex."""
+
+    def __init__(self, index, domain):
+        self.index = index
+        self.domain = domain
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        return self.index.search(self.domain, embedding, k)
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        return [doc for doc, _ in self.index.search(self.domain, embedding, k)]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4):
+        return self.index.search_batch(self.domain, embeddings, k)
+
+    def as_retriever(self, k=4):
+        return DomainRetriever(view=self, embeddings=self.index.store.embeddings, k=k)
+
+    def as_hybrid_retriever(self, k=4, fetch_k=20, rrf_k=60, fast_path_confidence=1.0):
+        return HybridRetriever(index=self.index, domain=self.domain, embeddings=self.index.store.embeddings,
+                               k=k, fetch_k=fetch_k, rrf_k=rrf_k, fast_path_confidence=fast_path_confidence)
+
+
+class DomainRetriever(BaseRetriever):
+    """Retriever over one domain of the shared index."""
+
+    view: Any
+    embeddings: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.view.similarity_search_by_vector(self.embeddings.embed_query(query), k=self.k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = await self.embeddings.aembed_query(query)
+        return self.view.similarity_search_by_vector(embedding, k=self.k)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    BM25 + vector retriever over one domain of the shared index. Both rankings
+    are cut to `fetch_k` and fused by reciprocal-rank fusion. If the BM25
+    confidence reaches `fast_path_confidence` (set it above 1 to disable), the
+    lexical top-k is returned without embedding the question.
+    """
+
+    index: Any
+    domain: str
+    embeddings: Any
+    k: int = 4
+    fetch_k: int = 20
+    rrf_k: int = 60
+    fast_path_confidence: float = 1.0
+
+    def _lexical(self, query):
+        ids, confidence = self.index.lexical_search(self.domain, query, self.fetch_k)
+        fast_path = len(ids) >= min(self.k, self.index.counts.get(self.domain, 0)) and \
+            confidence >= self.fast_path_confidence
+        record_cache("lexical_fast_path", hits=int(fast_path), misses=int(not fast_path))
+        return ids, fast_path
+
+    def _fuse(self, lexical_ids, dense_ids):
+        dense_ids = [int(i) for i in dense_ids if i != -1]
+        fused = reciprocal_rank_fusion([dense_ids, [int(i) for i in lexical_ids]], k=self.rrf_k)
+        return self.index.documents(fused[:self.k])
+
+    def _dense_ids(self, embeddings):
+        return self.index.search_rows(self.domain, embeddings, self.fetch_k)[1]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        lexical_ids, fast_path = self._lexical(query)
+        if fast_path:
+            return self.index.documents(lexical_ids[:self.k])
+        return self._fuse(lexical_ids, self._dense_ids([self.embeddings.embed_query(query)])[0])
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        lexical_ids, fast_path = self._lexical(query)
+        if fast_path:
+            return self.index.documents(lexical_ids[:self.k])
+        return self._fuse(lexical_ids, self._dense_ids([await self.embeddings.aembed_query(query)])[0])
+
+    def search_batch(self, queries, embeddings):
+        """
+        Same documents as invoke() for each of `queries`, whose embeddings are
+        already known (speculative and batch retrieval), with one vector search
+        for the questions that miss the fast path.
+        """
+        lexical = [self._lexical(query) for query in queries]
+        fused = [n for n, (_, fast_path) in enumerate(lexical) if not fast_path]
+        dense = dict(zip(fused, self._dense_ids([embeddings[n] for n in fused])))
+        return [
+            self._fuse(lexical_ids, dense[n]) if n in dense else self.index.documents(lexical_ids[:self.k])
+            for n, (lexical_ids, _) in enumerate(lexical)
+        ]
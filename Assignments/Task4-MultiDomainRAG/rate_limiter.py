@@ -0,0 +1,290 @@
+# rate_limiter.py
+
+# ==============================================================================
+# Client-side rate limiting, retries and backpressure for the OpenAI API
+# ==============================================================================
+# Under load the API answers 429 and the request used to fail with a 500. Every
+# OpenAI call of the process (chat and embeddings, sync and async) now goes
+# through one RateLimiter, plugged in as the transport of the shared httpx
+# clients in app.py:
+#   - two token buckets, requests per minute and tokens per minute. A request's
+#     tokens are estimated from its body (about 4 characters per token, plus
+#     max_tokens for a completion);
+#   - waiting requests queue by priority. Interactive requests (the default)
+#     go before BACKGROUND ones, which ingestion marks with
+#     request_priority(BACKGROUND) around its embedding calls;
+#   - a 429 or 5xx answer is retried up to `max_retries` times after a jittered
+#     exponential backoff, or after the Retry-After the server sent if that is
+#     longer. A 429 also halves the rates, which then grow back by 5% of the
+#     configured rate per successful call, and pauses all calls for the
+#     server's Retry-After;
+#   - when `max_queue` interactive requests are already waiting, or one waits
+#     longer than `max_wait` seconds, the call fails with Overloaded. The
+#     handlers answer it (and a 429 that outlived its retries) with 503 and a
+#     Retry-After header (see retry_after_of). Background requests only wait.
+# The OpenAI SDK's own retries are turned off, so a call is retried in one place.
+import math
+import time
+import json
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+import httpx
+from tracing import record_stage, openai_events
+
+INTERACTIVE = 0
+BACKGROUND = 1
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_priority = contextvars.ContextVar("openai_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def request_priority(priority):
+    """Runs the OpenAI calls made inside the block (and its copied contexts) at `priority`."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class Overloaded(Exception):
+    """The request could not be sent in time; retry after `retry_after` seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_after_of(error):
+    """
+    Seconds a client should wait before retrying when `error`, or an exception
+    it was raised from, is Overloaded or a 429 from the API; None otherwise.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, Overloaded):
+            return error.retry_after
+        if getattr(error, "status_code", None) == 429:
+            response = getattr(error, "response", None)
+            return _retry_after_header(response) or 1.0
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def _retry_after_header(response):
+    try:
+        return max(float(response.headers.get("retry-after", "")), 0.0)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(request):
+    """Rough token count of an OpenAI request from its JSON body."""
+    try:
+        body = json.loads(request.content or b"{}")
+    except ValueError:
+        return 1
+    if not isinstance(body, dict):
+        return 1
+    if "messages" in body:
+        chars = sum(len(str(m.get("content", ""))) for m in body["messages"] if isinstance(m, dict))
+        return chars // 4 + int(body.get("max_tokens") or body.get("max_completion_tokens") or 256)
+    inputs = body.get("input", "")
+    inputs = inputs if isinstance(inputs, list) else [inputs]
+    # Embedding inputs are strings or lists of token ids.
+    return sum(len(item) if isinstance(item, list) else len(str(item)) // 4 + 1 for item in inputs) or 1
+
+
+class RateLimiter:
+    """Request and token buckets shared by all OpenAI calls, with a priority queue of waiters."""
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000, max_queue=64, max_wait=10.0,
+                 max_retries=4, backoff_base=0.5, backoff_max=20.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._rate_factor = 1.0
+        self._paused_until = 0.0
+        self._updated = time.monotonic()
+        self._queue = []
+        self._interactive_waiting = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.throttled = 0
+        self.retries = 0
+        self.rejected = 0
+
+    # --------------------------------------------------------------------------
+    # Buckets and queue
+    # --------------------------------------------------------------------------
+    def _refill(self, now):
+        elapsed = max(now - max(self._updated, self._paused_until), 0.0)
+        self._updated = max(now, self._updated)
+        rate = self._rate_factor / 60.0
+        self._requests = min(self._requests + elapsed * self.requests_per_minute * rate, self.requests_per_minute)
+        self._tokens = min(self._tokens + elapsed * self.tokens_per_minute * rate, self.tokens_per_minute)
+
+    def _enter(self, priority):
+        with self._lock:
+            if priority == INTERACTIVE and self._interactive_waiting >= self.max_queue:
+                self.rejected += 1
+                openai_events.inc(kind="rejected")
+                raise Overloaded("OpenAI request queue is full", self._drain_seconds())
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._queue, ticket)
+            self._interactive_waiting += int(priority == INTERACTIVE)
+            return ticket
+
+    def _leave(self, ticket):
+        with self._lock:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._interactive_waiting -= int(ticket[0] == INTERACTIVE)
+
+    def _drain_seconds(self):
+        """Rough time for the current queue to be served, for Retry-After."""
+        rate = self.requests_per_minute * self._rate_factor / 60.0
+        paused = max(self._paused_until - time.monotonic(), 0.0)
+        return max(math.ceil(paused + len(self._queue) / max(rate, 1e-9)), 1)
+
+    def _try_take(self, ticket, tokens):
+        """Takes a request and `tokens` if `ticket` is first in line; returns 0 or seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._queue[0] != ticket:
+                return 0.005
+            tokens = min(tokens, self.tokens_per_minute)
+            rate = self._rate_factor / 60.0
+            missing = max((1 - self._requests) / (self.requests_per_minute * rate),
+                          (tokens - self._tokens) / (self.tokens_per_minute * rate))
+            if missing > 0:
+                return missing
+            self._requests -= 1
+            self._tokens -= tokens
+            heapq.heappop(self._queue)
+            self._interactive_waiting -= int(ticket[0] == INTERACTIVE)
+            return 0.0
+
+    def _check_deadline(self, ticket, deadline):
+        if ticket[0] == INTERACTIVE and time.monotonic() > deadline:
+            with self._lock:
+                self.rejected += 1
+            openai_events.inc(kind="rejected")
+            raise Overloaded("Timed out waiting for the OpenAI rate limit", self._drain_seconds())
+
+    def acquire(self, tokens):
+        """Blocks until the request may be sent."""
+        start = time.monotonic()
+        ticket = self._enter(_priority.get())
+        try:
+            while True:
+                wait = self._try_take(ticket, tokens)
+                if not wait:
+                    break
+                self._check_deadline(ticket, start + self.max_wait)
+                time.sleep(min(wait, 0.25))
+        finally:
+            self._leave(ticket)
+        record_stage("rate_limit_wait", time.monotonic() - start)
+
+    async def aacquire(self, tokens):
+        """Async version of acquire."""
+        start = time.monotonic()
+        ticket = self._enter(_priority.get())
+        try:
+            while True:
+                wait = self._try_take(ticket, tokens)
+                if not wait:
+                    break
+                self._check_deadline(ticket, start + self.max_wait)
+                await asyncio.sleep(min(wait, 0.25))
+        finally:
+            self._leave(ticket)
+        record_stage("rate_limit_wait", time.monotonic() - start)
+
+    # --------------------------------------------------------------------------
+    # Feedback from responses
+    # --------------------------------------------------------------------------
+    def backoff(self, attempt, response):
+        """Seconds to wait before retrying a failed response; slows the buckets down on a 429."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = _retry_after_header(response) or 0.0
+        delay = max(delay, retry_after + random.uniform(0, self.backoff_base)) if retry_after else delay
+        throttled = response.status_code == 429
+        with self._lock:
+            self.retries += 1
+            if throttled:
+                self.throttled += 1
+                self._rate_factor = max(self._rate_factor / 2, 0.1)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        openai_events.inc(kind="retry")
+        if throttled:
+            openai_events.inc(kind="throttled")
+        return delay
+
+    def succeeded(self):
+        with self._lock:
+            self._rate_factor = min(self._rate_factor + 0.05, 1.0)
+
+
+class RateLimitedTransport(httpx.HTTPTransport):
+    """httpx transport that sends every request through a RateLimiter and retries 429/5xx."""
+
+    def __init__(self, limiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    def handle_request(self, request):
+        request.read()
+        tokens = estimate_tokens(request)
+        for attempt in itertools.count():
+            self.limiter.acquire(tokens)
+            response = super().handle_request(request)
+            if response.status_code not in RETRY_STATUS:
+                self.limiter.succeeded()
+                return response
+            if attempt >= self.limiter.max_retries:
+                return response
+            delay = self.limiter.backoff(attempt, response)
+            response.close()
+            time.sleep(delay)
+
+
+class AsyncRateLimitedTransport(httpx.AsyncHTTPTransport):
+    """Async version of RateLimitedTransport."""
+
+    def __init__(self, limiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        tokens = estimate_tokens(request)
+        for attempt in itertools.count():
+            await self.limiter.aacquire(tokens)
+            response = await super().handle_async_request(request)
+            if response.status_code not in RETRY_STATUS:
+                self.limiter.succeeded()
+                return response
+            if attempt >= self.limiter.max_retries:
+                return response
+            delay = self.limiter.backoff(attempt, response)
+            await response.aclose()
+            await asyncio.sleep(delay)
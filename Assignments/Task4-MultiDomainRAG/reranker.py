@@ -0,0 +1,85 @@
+# reranker.py
+
+# ==============================================================================
+# Local reranking of retrieved chunks
+# ==============================================================================
+# The retrievers over-fetch candidates (RERANK_FETCH_K per question) and the
+# reranker keeps the best RERANK_TOP_N for the prompt, so {context} gets fewer
+# but better chunks and generation has a shorter prompt to read. Scoring is
+# local and cheap: every candidate is scored against the question's terms (see
+# lexical_index.tokenize) in one candidates x terms matrix:
+#   - BM25 of the question within the candidate pool, so terms that every
+#     candidate contains count for little (scaled to [0, 1]);
+#   - coverage: the IDF-weighted share of the question's terms it contains;
+#   - phrase overlap: the share of the question's adjacent term pairs it contains;
+#   - a prior from the retriever's own ranking, weighted by `prior_weight`, so
+#     a question with no useful terms keeps the retrieval order.
+# Tokenizing the candidates is the only per-chunk Python work, and it is cached
+# by text since the same chunks come back for many questions. If tokenizing
+# runs past `budget_ms`, the remaining candidates are not scored and keep their
+# retrieval order behind the scored ones.
+import time
+from functools import lru_cache
+import numpy as np
+from lexical_index import tokenize
+from tracing import record_stage
+
+
+@lru_cache(maxsize=20000)
+def _text_features(text):
+    """Term counts, length and adjacent term pairs of a chunk."""
+    tokens = tokenize(text)
+    counts = {}
+    for token in tokens:
+        counts[token] = counts.get(token, 0) + 1
+    return counts, len(tokens), frozenset(zip(tokens, tokens[1:]))
+
+
+class LexicalReranker:
+    """Keeps the top_n retrieved documents by term overlap with the question."""
+
+    def __init__(self, top_n=4, prior_weight=1.0, budget_ms=25.0, k1=1.2, b=0.75):
+        self.top_n = top_n
+        self.prior_weight = prior_weight
+        self.budget_ms = budget_ms
+        self.k1 = k1
+        self.b = b
+
+    def scores(self, query, features):
+        """Overlap scores of candidates (given as _text_features) against `query`, without the rank prior."""
+        query_tokens = tokenize(query)
+        terms = list(dict.fromkeys(query_tokens))
+        if not terms or not features:
+            return np.zeros(len(features), dtype="float32")
+        tf = np.array([[counts.get(term, 0) for term in terms] for counts, _, _ in features], dtype="float32")
+        lengths = np.array([length for _, length, _ in features], dtype="float32")
+
+        df = (tf > 0).sum(axis=0)
+        idf = np.log1p((len(features) - df + 0.5) / (df + 0.5))
+        norm = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1e-9))
+        bm25 = (idf * tf * (self.k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+        if bm25.max() > 0:
+            bm25 = bm25 / bm25.max()
+        coverage = ((tf > 0) * idf).sum(axis=1) / max(float(idf.sum()), 1e-9)
+
+        pairs = set(zip(query_tokens, query_tokens[1:]))
+        phrase = np.array([len(pairs & doc_pairs) for _, _, doc_pairs in features], dtype="float32")
+        phrase = phrase / max(len(pairs), 1)
+        return bm25 + coverage + phrase
+
+    def rerank(self, query, documents):
+        """Returns the top_n of `documents` (best first); they are given in retrieval order."""
+        if len(documents) <= 1:
+            return list(documents)
+        start = time.perf_counter()
+        features = []
+        for doc in documents:
+            if features and (time.perf_counter() - start) * 1000 > self.budget_ms:
+                break
+            features.append(_text_features(doc.page_content))
+
+        prior = 1.0 - np.arange(len(features), dtype="float32") / len(documents)
+        scores = self.scores(query, features) + self.prior_weight * prior
+        order = np.argsort(-scores, kind="stable").tolist() + list(range(len(features), len(documents)))
+        record_stage("rerank", time.perf_counter() - start)
+        return [documents[i] for i in order[:self.top_n]]
@@ -0,0 +1,148 @@
+# router_cache.py
+
+# ==============================================================================
+# Router decision cache, keyword pre-router and tolerant reply parsing
+# ==============================================================================
+# Guests ask the same few questions over and over, and the router LLM (or the
+# embedding router in front of it) used to decide each of them again. The
+# route of a question depends on nothing but its text, so CachedRouter answers
+# in this order and only calls the wrapped router on the last step:
+#   1. an LRU cache of normalized question -> destination (lower-cased words,
+#      punctuation and spacing dropped);
+#   2. KeywordRouter: the 'keywords' of each domain in domains.yaml, regular
+#      expressions matched at word boundaries. It only decides when exactly one
+#      domain matches, so "breakfast before check-out?" still goes to the router;
+#   3. the wrapped router; its decision is stored in the cache.
+#
+# The router LLM's reply is free-form text. parse_route reads the JSON object
+# from it, and if that fails it extracts the destination anyway: a
+# 'destination' key written loosely, then a single domain name mentioned in the
+# reply. Only a reply with none of these falls back to "default", and that
+# decision is not cached, so the question is routed again next time.
+import re
+import json
+import threading
+from collections import OrderedDict
+from tracing import record_cache
+
+_WORDS = re.compile(r"[a-z0-9]+")
+_JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+_DESTINATION = re.compile(r"""["']?destination["']?\s*[:=]\s*["']?([A-Za-z0-9_-]+)""", re.IGNORECASE)
+
+
+def normalize_question(text):
+    """Lower-cased words of a question, so 'What time is check-in?' == 'what time is check in'."""
+    return " ".join(_WORDS.findall(text.lower()))
+
+
+def parse_route(text, domain_names):
+    """
+    Reads {'destination', 'next_inputs'} from the router LLM's reply. A reply
+    that names no known domain routes to "default" with an 'error' key.
+    """
+    known = {name.lower(): name for name in domain_names}
+    known["default"] = "default"
+
+    data = None
+    match = _JSON_OBJECT.search(text)
+    if match:
+        try:
+            data = json.loads(match.group(0))
+        except ValueError:
+            data = None
+    if isinstance(data, dict) and str(data.get("destination", "")).strip().lower() in known:
+        return {"destination": known[str(data["destination"]).strip().lower()],
+                "next_inputs": data.get("next_inputs")}
+
+    match = _DESTINATION.search(text)
+    if match and match.group(1).lower() in known:
+        return {"destination": known[match.group(1).lower()], "next_inputs": None}
+
+    mentioned = {known[word] for word in _WORDS.findall(text.lower()) if word in known and word != "default"}
+    if len(mentioned) == 1:
+        return {"destination": mentioned.pop(), "next_inputs": None}
+
+    print(f"Warning: could not read a destination from the router reply {text[:200]!r}; using 'default'.")
+    return {"destination": "default", "next_inputs": None, "error": "unparsable router reply"}
+
+
+class KeywordRouter:
+    """Routes questions that match the keywords of exactly one domain."""
+
+    def __init__(self, keywords):
+        self.patterns = {
+            domain: re.compile(r"\b(?:" + "|".join(patterns) + r")\b", re.IGNORECASE)
+            for domain, patterns in keywords.items() if patterns
+        }
+
+    def route(self, question):
+        """Returns the destination, or None when no domain or several domains match."""
+        matches = [domain for domain, pattern in self.patterns.items() if pattern.search(question)]
+        return matches[0] if len(matches) == 1 else None
+
+
+class CachedRouter:
+    """Puts the decision cache and the keyword router in front of a router runnable."""
+
+    def __init__(self, router, keyword_router=None, max_entries=5000):
+        self.router = router
+        self.keyword_router = keyword_router
+        self.max_entries = max_entries
+        self._decisions = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.keyword_decisions = 0
+        self.misses = 0
+
+    def lookup(self, question):
+        """Returns a cached or keyword route for the question, or None if the router must decide."""
+        key = normalize_question(question)
+        with self._lock:
+            destination = self._decisions.get(key)
+            if destination is not None:
+                self._decisions.move_to_end(key)
+                self.hits += 1
+        if destination is not None:
+            record_cache("route", hits=1)
+            return {"destination": destination, "next_inputs": question}
+        record_cache("route", misses=1)
+
+        destination = self.keyword_router.route(question) if self.keyword_router else None
+        if destination is None:
+            with self._lock:
+                self.misses += 1
+            if self.keyword_router:
+                record_cache("keyword_route", misses=1)
+            return None
+        with self._lock:
+            self.keyword_decisions += 1
+        record_cache("keyword_route", hits=1)
+        self.add(question, {"destination": destination})
+        return {"destination": destination, "next_inputs": question}
+
+    def add(self, question, route):
+        """Caches the router's decision, unless it is a fallback for an unreadable reply."""
+        if not isinstance(route, dict) or route.get("error") or not route.get("destination"):
+            return
+        key = normalize_question(question)
+        with self._lock:
+            self._decisions[key] = route["destination"]
+            self._decisions.move_to_end(key)
+            while len(self._decisions) > self.max_entries:
+                self._decisions.popitem(last=False)
+
+    def route(self, inputs, config=None):
+        """Same {'destination', 'next_inputs'} dict as the wrapped router."""
+        decision = self.lookup(inputs["input"])
+        if decision is None:
+            decision = self.router.invoke(inputs, config)
+            self.add(inputs["input"], decision)
+        return decision
+
+    async def aroute(self, inputs, config=None):
+        """Async version of route."""
+        decision = self.lookup(inputs["input"])
+        if decision is None:
+            decision = await self.router.ainvoke(inputs, config)
+            self.add(inputs["input"], decision)
+        return decision
@@ -0,0 +1,121 @@
+# semantic_router.py
+
+# ==============================================================================
+# Local embedding-similarity router
+# ==============================================================================
+# The LLM router spends a full chat completion just to pick "dining", "rooms",
+# "wellness" or "default". EmbeddingRouter makes the same decision locally from
+# the query embedding (which the retriever needs anyway, and which the embedding
+# cache then serves for free):
+#   - "centroid" mode compares the query against the mean vector of a few
+#     exemplar questions per domain (the 'exemplars' in domains.yaml);
+#   - "index" mode uses the best hit score of the query in each domain's
+#     FAISS vector store.
+# When the best domain does not win by at least `margin`, or its score is below
+# `min_score`, the decision is handed to the LLM router (`fallback`).
+import numpy as np
+
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype="float32")
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class EmbeddingRouter:
+    """Routes a question to a domain by embedding similarity, falling back to an LLM router."""
+
+    def __init__(self, embeddings, fallback, mode="centroid", vector_stores=None,
+                 exemplars=None, margin=0.03, min_score=0.75):
+        self.embeddings = embeddings
+        self.fallback = fallback
+        self.mode = mode
+        self.vector_stores = vector_stores or {}
+        self.margin = margin
+        self.min_score = min_score
+        self.fallbacks = 0
+        self.local_decisions = 0
+
+        if mode == "centroid":
+            if not exemplars:
+                raise ValueError("ROUTER_MODE=centroid needs exemplar questions for the domains.")
+            self.domains = list(exemplars)
+            centroids = []
+            for domain in self.domains:
+                vectors = _normalize(embeddings.embed_documents(exemplars[domain]))
+                centroids.append(vectors.mean(axis=0))
+            self.centroids = _normalize(centroids)
+        elif mode == "index":
+            self.domains = list(self.vector_stores)
+        else:
+            raise ValueError(f"Unknown router mode: {mode}")
+
+    def _scores_for_vector(self, query_vector):
+        query_vector = _normalize(query_vector)
+        if self.mode == "centroid":
+            return dict(zip(self.domains, (self.centroids @ query_vector).tolist()))
+
+        scores = {}
+        for domain in self.domains:
+            hits = self.vector_stores[domain].similarity_search_with_score_by_vector(
+                query_vector.tolist(), k=1
+            )
+            # FAISS returns squared L2 distances; for unit vectors cos = 1 - d / 2.
+            scores[domain] = 1.0 - float(hits[0][1]) / 2.0 if hits else 0.0
+        return scores
+
+    def scores(self, query):
+        """Returns a {domain: cosine similarity} dict for the query."""
+        return self._scores_for_vector(self.embeddings.embed_query(query))
+
+    def _decide(self, query, scores):
+        """Returns the local routing decision, or None when it is ambiguous."""
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best_domain, best_score = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else -1.0
+        if best_score < self.min_score or best_score - runner_up < self.margin:
+            self.fallbacks += 1
+            return None
+        self.local_decisions += 1
+        return {"destination": best_domain, "next_inputs": query}
+
+    def route(self, inputs):
+        """Returns the same {'destination', 'next_inputs'} dict as the LLM router."""
+        decision = self._decide(inputs["input"], self.scores(inputs["input"]))
+        return decision if decision is not None else self.fallback.invoke(inputs)
+
+    async def aroute(self, inputs):
+        """Async version of route."""
+        query_vector = await self.embeddings.aembed_query(inputs["input"])
+        decision = self._decide(inputs["input"], self._scores_for_vector(query_vector))
+        return decision if decision is not None else await self.fallback.ainvoke(inputs)
+
+    def _score_matrix(self, query_vectors):
+        """Returns an (n_queries, n_domains) matrix of cosine similarities."""
+        queries = _normalize(query_vectors)
+        if self.mode == "centroid":
+            return queries @ self.centroids.T
+
+        columns = []
+        for domain in self.domains:
+            hits = self.vector_stores[domain].similarity_search_with_score_by_vectors(queries, k=1)
+            columns.append([1.0 - float(h[0][1]) / 2.0 if h else 0.0 for h in hits])
+        return np.array(columns, dtype="float32").T
+
+    def route_batch(self, inputs_list, query_vectors, config=None):
+        """
+        Routes many questions from their precomputed embeddings. The ambiguous
+        ones go to the LLM router in a single batch; a failed fallback call is
+        returned as its exception.
+        """
+        scores = self._score_matrix(query_vectors)
+        decisions = [
+            self._decide(inputs["input"], dict(zip(self.domains, row.tolist())))
+            for inputs, row in zip(inputs_list, scores)
+        ]
+        pending = [i for i, decision in enumerate(decisions) if decision is None]
+        if pending:
+            fallback = self.fallback.batch([inputs_list[i] for i in pending], config, return_exceptions=True)
+            for i, decision in zip(pending, fallback):
+                decisions[i] = decision
+        return decisions
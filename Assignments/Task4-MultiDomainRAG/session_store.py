@@ -0,0 +1,149 @@
+# session_store.py
+
+# ==============================================================================
+# Per-session conversation history
+# ==============================================================================
+# Each guest gets their own history, keyed by a session id cookie, instead of
+# one global list shared by every request. A history keeps at most `max_turns`
+# question/answer pairs and roughly `max_tokens` tokens (estimated at four
+# characters per token); older turns are dropped first. Sessions idle for longer
+# than `ttl_seconds` are evicted, so memory stays flat under load.
+#
+# Two backends share the same get/append_turn interface:
+#   - InMemoryHistoryStore, the default, guarded by a lock;
+#   - RedisHistoryStore, for histories shared between workers. It only needs a
+#     client with rpush/lrange/ltrim/expire/delete, so a local stand-in can
+#     replace Redis in tests.
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from langchain_core.messages import HumanMessage, AIMessage
+
+
+def estimate_tokens(text):
+    """Cheap token estimate used for the history budget."""
+    return max(1, len(text) // 4)
+
+
+def _trim_turns(turns, max_turns, max_tokens):
+    """Drops the oldest (question, answer) pairs until both caps are respected."""
+    turns = turns[-max_turns:] if max_turns else turns
+    total = sum(estimate_tokens(q) + estimate_tokens(a) for q, a in turns)
+    while turns and max_tokens and total > max_tokens:
+        q, a = turns.pop(0)
+        total -= estimate_tokens(q) + estimate_tokens(a)
+    return turns
+
+
+def _to_messages(turns):
+    messages = []
+    for question, answer in turns:
+        messages.append(HumanMessage(content=question))
+        messages.append(AIMessage(content=answer))
+    return messages
+
+
+class InMemoryHistoryStore:
+    """Session-keyed chat histories held in this process."""
+
+    def __init__(self, max_turns=10, max_tokens=2000, ttl_seconds=1800, max_sessions=10000):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        # session id -> (last seen timestamp, list of (question, answer)), oldest first.
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._sessions:
+            session_id, (last_seen, _) = next(iter(self._sessions.items()))
+            if now - last_seen <= self.ttl_seconds and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def get(self, session_id):
+        """Returns a copy of the session's history as chat messages."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return []
+            self._sessions[session_id] = (now, entry[1])
+            self._sessions.move_to_end(session_id)
+            return _to_messages(entry[1])
+
+    def append_turn(self, session_id, question, answer):
+        """Adds one question/answer pair to the session, trimming it to the caps."""
+        now = time.monotonic()
+        with self._lock:
+            _, turns = self._sessions.pop(session_id, (now, []))
+            turns = _trim_turns(turns + [(question, answer)], self.max_turns, self.max_tokens)
+            self._sessions[session_id] = (now, turns)
+            self._evict(now)
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+class RedisHistoryStore:
+    """Session-keyed chat histories in Redis (or any client with the same list commands)."""
+
+    def __init__(self, client, max_turns=10, max_tokens=2000, ttl_seconds=1800, prefix="chat_history:"):
+        self.client = client
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def _key(self, session_id):
+        return f"{self.prefix}{session_id}"
+
+    def _turns(self, key):
+        return [tuple(json.loads(item)) for item in self.client.lrange(key, 0, -1)]
+
+    def get(self, session_id):
+        """Returns the session's history as chat messages and refreshes its TTL."""
+        key = self._key(session_id)
+        turns = self._turns(key)
+        if turns:
+            self.client.expire(key, self.ttl_seconds)
+        return _to_messages(turns)
+
+    def append_turn(self, session_id, question, answer):
+        """Adds one question/answer pair to the session, trimming it to the caps."""
+        key = self._key(session_id)
+        self.client.rpush(key, json.dumps([question, answer]))
+        turns = self._turns(key)
+        kept = _trim_turns(list(turns), self.max_turns, self.max_tokens)
+        if len(kept) < len(turns):
+            self.client.ltrim(key, len(turns) - len(kept), -1)
+        self.client.expire(key, self.ttl_seconds)
+
+    def clear(self, session_id):
+        self.client.delete(self._key(session_id))
+
+
+def make_history_store():
+    """Builds the history store selected by SESSION_BACKEND (memory or redis)."""
+    settings = {
+        "max_turns": int(os.getenv("SESSION_MAX_TURNS", "10")),
+        "max_tokens": int(os.getenv("SESSION_MAX_TOKENS", "2000")),
+        "ttl_seconds": int(os.getenv("SESSION_TTL_SECONDS", "1800")),
+    }
+    if os.getenv("SESSION_BACKEND", "memory") == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("SESSION_BACKEND=redis needs the redis package: pip install redis")
+        client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        return RedisHistoryStore(client, **settings)
+    return InMemoryHistoryStore(max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", "10000")), **settings)
@@ -0,0 +1,205 @@
+# single_flight.py
+
+# ==============================================================================
+# Coalescing of identical in-flight requests
+# ==============================================================================
+# When a conference group arrives, dozens of guests ask the same question within
+# seconds. The answer cache only helps once the first answer is stored, so until
+# then every one of them ran its own router and generation calls. SingleFlight
+# runs one computation per key at a time: the first caller (the leader) starts
+# it, and callers arriving with the same key while it is in flight wait for it
+# and get the same result, or the same exception. Nothing is kept once the
+# computation ends; storing answers is the answer cache's job.
+#
+# The async version runs the computation as a task that every caller awaits
+# through asyncio.shield, so a leader whose client disconnects does not cancel
+# the answer the others are waiting for.
+#
+# stream() and astream() do the same for a computation that yields events (the
+# route and answer tokens of /chat/stream). The leader's iterator runs in a
+# thread (or task) of its own and keeps every event it yields; each caller
+# replays them from the first one and then follows the new ones as they come,
+# so a caller that joins late still gets the whole answer. The events are
+# dropped when the iterator ends.
+#
+# Every call is counted in the cache lookup counters under the flight's name:
+# a "hit" is a call that was collapsed into another one, a "miss" a call that
+# did the work.
+import asyncio
+import threading
+import contextvars
+from tracing import record_cache
+
+
+class _Call:
+    """A computation in flight and the callers waiting for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Stream:
+    """The events a streamed computation yielded so far, and how it ended."""
+
+    def __init__(self, changed):
+        self.changed = changed
+        self.events = []
+        self.done = False
+        self.error = None
+        self.task = None
+
+
+class SingleFlight:
+    """Shares one in-flight computation between concurrent callers with the same key."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._tasks = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.collapsed = 0
+
+    def _count(self, shared):
+        with self._lock:
+            self.calls += 1
+            self.collapsed += int(shared)
+        record_cache(self.name, hits=int(shared), misses=int(not shared))
+
+    def do(self, key, func):
+        """Returns (func(), shared); `shared` is True when another caller's result was reused."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        self._count(shared=not leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def ado(self, key, func):
+        """Async version of do; `func` returns a coroutine."""
+        with self._lock:
+            task = self._tasks.get(key)
+            leader = task is None
+            if leader:
+                task = self._tasks[key] = asyncio.ensure_future(func())
+                task.add_done_callback(lambda done: self._forget(key, done))
+        self._count(shared=not leader)
+        return await asyncio.shield(task), not leader
+
+    def _forget(self, key, task):
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+        # Mark the exception as retrieved when no caller is left to await it.
+        if not task.cancelled():
+            task.exception()
+
+    def stream(self, key, func):
+        """
+        Returns (events, shared): an iterator over the items of the iterator
+        `func()` returns, and True when another caller's run is being replayed.
+        """
+        with self._lock:
+            stream = self._streams.get(key)
+            leader = stream is None
+            if leader:
+                stream = self._streams[key] = _Stream(threading.Condition())
+        self._count(shared=not leader)
+        if leader:
+            # The thread gets a copy of the leader's context, so its stages land in the leader's trace.
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self._produce, key, stream, func), daemon=True).start()
+        return self._replay(stream), not leader
+
+    def _produce(self, key, stream, func):
+        try:
+            for event in func():
+                with stream.changed:
+                    stream.events.append(event)
+                    stream.changed.notify_all()
+        except Exception as e:
+            stream.error = e
+        finally:
+            self._end_stream(key, stream)
+            with stream.changed:
+                stream.done = True
+                stream.changed.notify_all()
+
+    def _replay(self, stream):
+        seen = 0
+        while True:
+            with stream.changed:
+                stream.changed.wait_for(lambda: seen < len(stream.events) or stream.done)
+                events = stream.events[seen:]
+                finished = stream.done and not events
+            if finished:
+                if stream.error is not None:
+                    raise stream.error
+                return
+            seen += len(events)
+            yield from events
+
+    async def astream(self, key, func):
+        """Async version of stream; `func` returns an async iterator."""
+        with self._lock:
+            stream = self._streams.get(key)
+            leader = stream is None
+            if leader:
+                stream = self._streams[key] = _Stream(asyncio.Condition())
+                stream.task = asyncio.ensure_future(self._aproduce(key, stream, func))
+        self._count(shared=not leader)
+        return self._areplay(stream), not leader
+
+    async def _aproduce(self, key, stream, func):
+        try:
+            async for event in func():
+                async with stream.changed:
+                    stream.events.append(event)
+                    stream.changed.notify_all()
+        except Exception as e:
+            stream.error = e
+        finally:
+            self._end_stream(key, stream)
+            async with stream.changed:
+                stream.done = True
+                stream.changed.notify_all()
+
+    async def _areplay(self, stream):
+        seen = 0
+        while True:
+            async with stream.changed:
+                await stream.changed.wait_for(lambda: seen < len(stream.events) or stream.done)
+                events = stream.events[seen:]
+                finished = stream.done and not events
+            if finished:
+                if stream.error is not None:
+                    raise stream.error
+                return
+            seen += len(events)
+            for event in events:
+                yield event
+
+    def _end_stream(self, key, stream):
+        with self._lock:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
@@ -0,0 +1,191 @@
+# stub_openai_server.py
+
+# ==============================================================================
+# Local stub of the OpenAI API for load tests and offline runs
+# ==============================================================================
+# Implements just enough of /v1/chat/completions and /v1/embeddings for the
+# concierge app to run without network access or API costs:
+#   - router prompts get a JSON routing decision picked by keywords,
+#   - every other prompt gets a short canned answer,
+#   - embeddings are deterministic hashed bag-of-tokens vectors, so similar
+#     texts still get similar vectors.
+# STUB_LATENCY_MS adds a fixed delay per request to mimic a real API, and
+# STUB_TOKEN_DELAY_MS a delay per token when the client asks for stream=true.
+# STUB_ROUTER_FORMAT=prose wraps the routing JSON in chatty text and a code
+# fence, the way a real model sometimes answers.
+# To exercise the client's rate limiting, STUB_RPM answers 429 once more than
+# that many requests arrived in the last minute, and STUB_429_RATE answers that
+# share of all requests with 429; both send Retry-After: STUB_RETRY_AFTER_S.
+#
+# Usage:
+#   uvicorn stub_openai_server:app --port 8001
+#   OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=stub python app.py
+import os
+import re
+import time
+import json
+import base64
+import random
+import asyncio
+import hashlib
+from array import array
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "0"))
+STUB_TOKEN_DELAY_MS = float(os.getenv("STUB_TOKEN_DELAY_MS", "0"))
+EMBEDDING_DIM = int(os.getenv("STUB_EMBEDDING_DIM", "256"))
+STUB_ROUTER_FORMAT = os.getenv("STUB_ROUTER_FORMAT", "json")
+STUB_RPM = int(os.getenv("STUB_RPM", "0"))
+STUB_429_RATE = float(os.getenv("STUB_429_RATE", "0"))
+STUB_RETRY_AFTER_S = os.getenv("STUB_RETRY_AFTER_S", "1")
+_recent_requests = []
+
+ROUTING_KEYWORDS = {
+    "dining": ["restaurant", "breakfast", "brunch", "dinner", "lunch", "menu", "food", "room service"],
+    "rooms": ["check-in", "check in", "check-out", "check out", "room", "suite", "wi-fi", "housekeeping", "pillow"],
+    "wellness": ["spa", "massage", "gym", "yoga", "pool", "wellness", "fitness"],
+}
+
+
+def route_question(question):
+    """Picks a domain for a question by keyword, the way the LLM router would."""
+    lowered = question.lower()
+    for domain, keywords in ROUTING_KEYWORDS.items():
+        if any(keyword in lowered for keyword in keywords):
+            return domain
+    return "default"
+
+
+def embed_item(item):
+    """Hashes tokens (token ids or words) into a fixed-size, L2-normalized vector."""
+    if isinstance(item, str):
+        tokens = re.findall(r"\w+", item.lower())
+    else:
+        tokens = [str(token) for token in item]
+    vector = [0.0] * EMBEDDING_DIM
+    for token in tokens:
+        digest = hashlib.md5(token.encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % EMBEDDING_DIM] += 1.0
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+async def simulate_latency():
+    if STUB_LATENCY_MS:
+        await asyncio.sleep(STUB_LATENCY_MS / 1000)
+
+
+def rate_limited():
+    """Returns a 429 response when the request is over STUB_RPM or picked by STUB_429_RATE, else None."""
+    now = time.monotonic()
+    if STUB_RPM:
+        while _recent_requests and now - _recent_requests[0] > 60:
+            _recent_requests.pop(0)
+        over = len(_recent_requests) >= STUB_RPM
+        if not over:
+            _recent_requests.append(now)
+    else:
+        over = False
+    if over or random.random() < STUB_429_RATE:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (stub).", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429, headers={"Retry-After": STUB_RETRY_AFTER_S},
+        )
+    return None
+
+
+async def chat_completions(request):
+    body = await request.json()
+    limited = rate_limited()
+    if limited is not None:
+        return limited
+    await simulate_latency()
+    prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+
+    if "determine the most relevant domain" in prompt:
+        question = prompt.rsplit("Question:", 1)[-1].split("Response:", 1)[0].strip()
+        content = f'{{"destination": "{route_question(question)}", "next_inputs": "{question}"}}'
+        if STUB_ROUTER_FORMAT == "prose":
+            content = f"Sure! Here is the routing decision:\n```json\n{content}\n```\nLet me know if you need more."
+    else:
+        content = "This is a stub answer from the local OpenAI server."
+
+    if body.get("stream"):
+        return StreamingResponse(stream_completion(body.get("model", "stub"), content),
+                                 media_type="text/event-stream")
+
+    prompt_tokens = len(prompt.split())
+    completion_tokens = len(content.split())
+    return JSONResponse({
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    })
+
+
+async def stream_completion(model, content):
+    """Yields the completion word by word as chat.completion.chunk events."""
+    def chunk(delta, finish_reason=None):
+        payload = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    words = content.split(" ")
+    for i, word in enumerate(words):
+        if STUB_TOKEN_DELAY_MS:
+            await asyncio.sleep(STUB_TOKEN_DELAY_MS / 1000)
+        yield chunk({"content": word if i == 0 else " " + word})
+    yield chunk({}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+async def embeddings(request):
+    body = await request.json()
+    limited = rate_limited()
+    if limited is not None:
+        return limited
+    await simulate_latency()
+    items = body.get("input", [])
+    # A single string or a single list of token ids is one input.
+    if isinstance(items, str) or (items and isinstance(items[0], int)):
+        items = [items]
+
+    data = []
+    for i, item in enumerate(items):
+        vector = embed_item(item)
+        if body.get("encoding_format") == "base64":
+            vector = base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+        data.append({"object": "embedding", "index": i, "embedding": vector})
+
+    tokens = sum(len(item) if not isinstance(item, str) else len(item.split()) for item in items)
+    return JSONResponse({
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "stub"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    })
+
+
+app = Starlette(routes=[
+    Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    Route("/v1/embeddings", embeddings, methods=["POST"]),
+])
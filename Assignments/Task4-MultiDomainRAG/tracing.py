@@ -0,0 +1,296 @@
+# tracing.py
+
+# ==============================================================================
+# Per-stage latency tracing and Prometheus metrics
+# ==============================================================================
+# A RequestTrace is a LangChain callback handler created for each request and
+# passed to the chains in their config. It times the named LCEL stages ("route",
+# "retrieve", "answer"), every retriever run and every chat model run (split
+# into the router LLM and answer generation), and adds up the token usage the
+# models report. Work that does not go through callbacks (embedding calls,
+# FAISS searches, cache lookups) reports to the request's trace with
+# record_stage/record_cache, which find it through a context variable.
+#
+# Every observation also goes into the process-wide histograms and counters
+# below, which /metrics renders in the Prometheus text format. When the request
+# finishes, its trace prints one JSON log line with the stage durations, tokens
+# and cache hits. The handlers run inline and only take a lock and read the
+# clock, so tracing can stay on in production.
+import json
+import time
+import uuid
+import threading
+import contextvars
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Histogram buckets in seconds, from a cache hit up to a slow LLM call.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Run names of the LCEL stages built in app.py.
+CHAIN_STAGES = ("route", "retrieve", "answer")
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class Histogram:
+    """Prometheus histogram with labels."""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, {'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': '+Inf'})} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Counter:
+    """Prometheus counter with labels."""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+stage_seconds = Histogram("concierge_stage_seconds", "Time spent in each pipeline stage.")
+request_seconds = Histogram("concierge_request_seconds", "End-to-end request latency.")
+llm_tokens = Counter("concierge_llm_tokens_total", "LLM tokens used, by stage and kind.")
+cache_lookups = Counter("concierge_cache_lookups_total", "Cache lookups, by cache and result.")
+requests_total = Counter("concierge_requests_total", "Handled requests, by endpoint and status.")
+openai_events = Counter("concierge_openai_rate_limit_total", "OpenAI calls retried, throttled or rejected, by kind.")
+METRICS = (stage_seconds, request_seconds, llm_tokens, cache_lookups, requests_total, openai_events)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render_metrics():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def record_stage(stage, seconds):
+    """Records a stage duration in the histograms and in the current request's trace."""
+    stage_seconds.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+
+def record_cache(cache, hits=0, misses=0):
+    """Records cache hits and misses in the counters and in the current request's trace."""
+    if hits:
+        cache_lookups.inc(hits, cache=cache, result="hit")
+    if misses:
+        cache_lookups.inc(misses, cache=cache, result="miss")
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_cache(cache, hits, misses)
+
+
+def _token_usage(response):
+    """Reads (prompt, completion) token counts from an LLMResult."""
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    prompt = completion = 0
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            prompt += metadata.get("input_tokens", 0)
+            completion += metadata.get("output_tokens", 0)
+    return prompt, completion
+
+
+class RequestTrace(BaseCallbackHandler):
+    """
+    Collects the stage timings, tokens and cache hits of one request. Pass it
+    in the chain config (config={"callbacks": [trace]}) and run the request
+    inside `with trace:` so non-callback stages can find it.
+    """
+
+    run_inline = True
+    raise_error = False
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.request_id = uuid.uuid4().hex[:12]
+        self.fields = {}
+        self.stages = {}
+        self.tokens = {}
+        self.cache = {}
+        self.error = None
+        self._runs = {}
+        self._parents = {}
+        self._lock = threading.Lock()
+        self._token = None
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            _current_trace.reset(self._token)
+        except ValueError:
+            # Left in another task than it was entered in: asgi_app.py starts a stream
+            # in the request's task and the server may finish it in a task of its own,
+            # whose copy of the context ends with it.
+            pass
+        if exc is not None and self.error is None:
+            self.fail(exc)
+        self.finish()
+        return False
+
+    def set(self, **fields):
+        """Adds fields (route, session, ...) to the request's log line."""
+        self.fields.update(fields)
+
+    def fail(self, error):
+        """Marks the request as failed; the error is logged with the trace."""
+        self.error = f"{type(error).__name__}: {error}"
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_cache(self, cache, hits, misses):
+        with self._lock:
+            counts = self.cache.setdefault(cache, {"hits": 0, "misses": 0})
+            counts["hits"] += hits
+            counts["misses"] += misses
+
+    def _stage_of(self, run_id):
+        """Returns the name of the nearest enclosing LCEL stage of a run."""
+        while run_id is not None:
+            run = self._runs.get(run_id)
+            if run is not None and run[0] in CHAIN_STAGES:
+                return run[0]
+            run_id = self._parents.get(run_id)
+        return None
+
+    def _start_run(self, stage, run_id, parent_run_id):
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            if stage is not None:
+                self._runs[run_id] = (stage, time.perf_counter())
+
+    def _end_run(self, run_id):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+            self._parents.pop(run_id, None)
+        if run is not None:
+            seconds = time.perf_counter() - run[1]
+            stage_seconds.observe(seconds, stage=run[0])
+            self.add_stage(run[0], seconds)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name")
+        self._start_run(name if name in CHAIN_STAGES else None, run_id, parent_run_id)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end_run(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end_run(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        self._start_run("retrieval", run_id, parent_run_id)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end_run(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end_run(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            stage = "router_llm" if self._stage_of(parent_run_id) == "route" else "generation"
+        self._start_run(stage, run_id, parent_run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            run = self._runs.get(run_id)
+        # Streamed responses may not report usage; they are left out of the counts.
+        if run is not None and any(_token_usage(response)):
+            prompt, completion = _token_usage(response)
+            llm_tokens.inc(prompt, stage=run[0], kind="prompt")
+            llm_tokens.inc(completion, stage=run[0], kind="completion")
+            with self._lock:
+                counts = self.tokens.setdefault(run[0], {"prompt": 0, "completion": 0})
+                counts["prompt"] += prompt
+                counts["completion"] += completion
+        self._end_run(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end_run(run_id)
+
+    def finish(self):
+        """Records the request latency and prints the request's structured log line."""
+        total = time.perf_counter() - self._start
+        status = "error" if self.error else "ok"
+        request_seconds.observe(total, endpoint=self.endpoint)
+        requests_total.inc(endpoint=self.endpoint, status=status)
+        line = {
+            "event": "request",
+            "request_id": self.request_id,
+            "endpoint": self.endpoint,
+            "status": status,
+            **self.fields,
+            "total_ms": round(total * 1000, 1),
+            "stages_ms": {stage: round(s * 1000, 1) for stage, s in self.stages.items()},
+            "tokens": self.tokens,
+            "cache": self.cache,
+        }
+        if self.error:
+            line["error"] = self.error
+        print(json.dumps(line))